@@ -0,0 +1,303 @@
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from wqpFunctions import outputProfile, overviewFactors, OUTPUT_PRESETS, OVERVIEW_RESAMPLING
+
+"""
+BANDMATHS EXPRESSIONS IN PYTHON
+"""
+# Subset of the SNAP band maths syntax used by the wqpSNAPparams_* expressions:
+# if/then/else, ?:, and/or/not (&&, ||, !), comparisons, arithmetic, functions,
+# 'quoted' band names, NaN, true/false
+TOKEN_REGEX = re.compile(r"""
+    \s*(?:
+    (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|
+    '(?P<quoted>[^']*)'|
+    (?P<name>[A-Za-z_][A-Za-z0-9_.]*)|
+    (?P<op><=|>=|==|!=|&&|\|\||[-+*/%()<>!,?:])
+    )""", re.VERBOSE)
+KEYWORDS = {'if', 'then', 'else', 'and', 'or', 'not'}
+CONSTANTS = {'NaN': np.nan, 'true': 1.0, 'false': 0.0, 'PI': np.pi, 'E': np.e}
+FUNCTIONS = {
+    'log': np.log, 'log10': np.log10, 'exp': np.exp, 'sqrt': np.sqrt, 'abs': np.abs,
+    'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'floor': np.floor, 'ceil': np.ceil,
+    'sign': np.sign, 'rad': np.radians, 'deg': np.degrees, 'pow': np.power,
+    'min': np.minimum, 'max': np.maximum, 'nan': np.isnan, 'inf': np.isinf,
+}
+COMPARISONS = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal,
+               '==': np.equal, '!=': np.not_equal}
+ARITHMETIC = {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.divide, '%': np.fmod}
+
+def tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = TOKEN_REGEX.match(expression, pos)
+        if match is None or match.end() == pos:
+            raise SyntaxError(f'Invalid expression at {pos}: {expression}')
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'name' and value in KEYWORDS:
+            kind = 'op'
+        tokens.append((kind, value))
+    return tokens
+
+class expressionParser:
+    """
+    Recursive descent parser of a band maths expression. The result is a tree of
+    tuples, e.g. ('if', cond, a, b), ('and', a, b), ('var', 'conc_chl'), so equal
+    sub-expressions of different expressions are equal (hashable) nodes.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][1] if self.pos < len(self.tokens) else None
+
+    def take(self, *values):
+        if self.peek() in values and self.tokens[self.pos][0] == 'op':
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, value):
+        if not self.take(value):
+            raise SyntaxError(f"Expected '{value}' at token {self.pos}: {self.expression}")
+
+    def parse(self):
+        node = self.expr()
+        if self.pos != len(self.tokens):
+            raise SyntaxError(f'Unexpected token {self.peek()!r}: {self.expression}')
+        return node
+
+    def expr(self):
+        if self.take('if'):
+            cond = self.expr()
+            self.expect('then')
+            a = self.expr()
+            self.expect('else')
+            return ('if', cond, a, self.expr())
+        node = self.orExpr()
+        if self.take('?'):
+            a = self.expr()
+            self.expect(':')
+            return ('if', node, a, self.expr())
+        return node
+
+    def orExpr(self):
+        node = self.andExpr()
+        while self.take('or', '||'):
+            node = ('or', node, self.andExpr())
+        return node
+
+    def andExpr(self):
+        node = self.notExpr()
+        while self.take('and', '&&'):
+            node = ('and', node, self.notExpr())
+        return node
+
+    def notExpr(self):
+        if self.take('not', '!'):
+            return ('not', self.notExpr())
+        return self.comparison()
+
+    def comparison(self):
+        node = self.additive()
+        if self.peek() in COMPARISONS and self.take(self.peek()):
+            op = self.tokens[self.pos - 1][1]
+            node = ('cmp', op, node, self.additive())
+        return node
+
+    def additive(self):
+        node = self.multiplicative()
+        while self.peek() in ('+', '-') and self.take(self.peek()):
+            node = ('arith', self.tokens[self.pos - 1][1], node, self.multiplicative())
+        return node
+
+    def multiplicative(self):
+        node = self.unary()
+        while self.peek() in ('*', '/', '%') and self.take(self.peek()):
+            node = ('arith', self.tokens[self.pos - 1][1], node, self.unary())
+        return node
+
+    def unary(self):
+        if self.take('-'):
+            return ('neg', self.unary())
+        if self.take('+'):
+            return self.unary()
+        return self.primary()
+
+    def primary(self):
+        if self.pos >= len(self.tokens):
+            raise SyntaxError(f'Unexpected end of expression: {self.expression}')
+        kind, value = self.tokens[self.pos]
+        if self.take('('):
+            node = self.expr()
+            self.expect(')')
+            return node
+        self.pos += 1
+        if kind == 'number':
+            return ('num', float(value))
+        if kind == 'quoted':
+            return ('var', value)
+        if kind == 'name':
+            if self.take('('):
+                args = []
+                if not self.take(')'):
+                    args.append(self.expr())
+                    while self.take(','):
+                        args.append(self.expr())
+                    self.expect(')')
+                if value not in FUNCTIONS:
+                    raise SyntaxError(f'Unknown function {value}: {self.expression}')
+                return ('call', value, tuple(args))
+            if value in CONSTANTS:
+                return ('num', CONSTANTS[value])
+            return ('var', value)
+        raise SyntaxError(f'Unexpected token {value!r}: {self.expression}')
+
+def parseExpression(expression):
+    return expressionParser(expression).parse()
+
+def variables(node):
+    # Band names used by an expression tree
+    if node[0] == 'var':
+        return {node[1]}
+    children = node[2] if node[0] == 'call' else [child for child in node[1:] if isinstance(child, tuple)]
+    return set().union(*[variables(child) for child in children]) if children else set()
+
+def toBool(x):
+    # Numeric values are true when not zero (as in SNAP)
+    x = np.asarray(x)
+    return x if x.dtype == bool else x != 0
+
+def evaluateNode(node, sources, memo):
+    # Evaluation of an expression tree: every sub-expression is computed once per memo
+    if node in memo:
+        return memo[node]
+    kind = node[0]
+    if kind == 'num':
+        value = node[1]
+    elif kind == 'var':
+        if node[1] not in sources:
+            raise KeyError(f'Unknown band in expression: {node[1]}')
+        value = sources[node[1]]
+    elif kind == 'if':
+        cond = toBool(evaluateNode(node[1], sources, memo))
+        value = np.where(cond, evaluateNode(node[2], sources, memo), evaluateNode(node[3], sources, memo))
+    elif kind == 'and':
+        value = toBool(evaluateNode(node[1], sources, memo)) & toBool(evaluateNode(node[2], sources, memo))
+    elif kind == 'or':
+        value = toBool(evaluateNode(node[1], sources, memo)) | toBool(evaluateNode(node[2], sources, memo))
+    elif kind == 'not':
+        value = ~toBool(evaluateNode(node[1], sources, memo))
+    elif kind == 'cmp':
+        value = COMPARISONS[node[1]](evaluateNode(node[2], sources, memo), evaluateNode(node[3], sources, memo))
+    elif kind == 'arith':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            value = ARITHMETIC[node[1]](evaluateNode(node[2], sources, memo), evaluateNode(node[3], sources, memo))
+    elif kind == 'neg':
+        value = np.negative(evaluateNode(node[1], sources, memo))
+    elif kind == 'call':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            value = FUNCTIONS[node[1]](*[evaluateNode(arg, sources, memo) for arg in node[2]])
+    else:
+        raise ValueError(f'Unknown node: {kind}')
+    memo[node] = value
+    return value
+
+class bandMaths:
+    """
+    Target bands of a SNAP BandMaths operator (the 'targetBands' of the
+    wqpSNAPparams_* parameters) evaluated with numpy. All the expressions are
+    parsed once and evaluated together, so the sub-expressions shared by several
+    target bands (e.g. the cloud/out of scope masks of the chl/tsm variants) are
+    computed once per chunk.
+        targetBands: list of {'name', 'type', 'expression'}
+    """
+    def __init__(self, targetBands):
+        self.targetBands = list(targetBands)
+        self.names = [tb['name'] for tb in self.targetBands]
+        self.trees = [parseExpression(tb['expression']) for tb in self.targetBands]
+        self.dtypes = [np.dtype(tb.get('type', 'float32')) for tb in self.targetBands]
+        self.variables = [sorted(variables(tree)) for tree in self.trees]
+        self.sourceNames = sorted(set().union(*self.variables))
+
+    def select(self, names):
+        # Evaluator with only some of the target bands
+        missing = set(names) - set(self.names)
+        if missing:
+            raise KeyError(f'Unknown target bands: {sorted(missing)}')
+        return bandMaths([tb for tb in self.targetBands if tb['name'] in names])
+
+    def evaluate(self, sources):
+        """
+        Evaluate the target bands on arrays of the source bands ({band name: array}).
+        Returns {target band name: array}.
+        """
+        memo = dict()
+        results = dict()
+        shape = np.broadcast(*[sources[v] for v in self.sourceNames]).shape if self.sourceNames else ()
+        for name, tree, dtype in zip(self.names, self.trees, self.dtypes):
+            value = evaluateNode(tree, sources, memo)
+            results[name] = np.broadcast_to(value, shape).astype(dtype)
+        return results
+
+    def evaluateRaster(self, src_path, out_paths, sourceNames=None, chunkRows=512, workers=4, preset='plain'):
+        """
+        Evaluate the target bands on a multi-band raster (e.g. the C2RCC concentrations
+        and flags exported once with params_bandMaths_sources) and write each target
+        band into its own GeoTIFF. The raster is processed in chunks of rows by a pool
+        of threads (each one with its own dataset handle).
+            src_path: raster with the source bands
+            out_paths: {target band name: output GeoTIFF}
+            sourceNames: band names of the raster by band order (default: band descriptions)
+        """
+        evaluator = self.select(list(out_paths))
+        local = threading.local()
+        lock = threading.Lock()
+        handles = []
+        with rasterio.open(src_path) as src:
+            if sourceNames is None:
+                sourceNames = list(src.descriptions)
+            indexes = {name: idx + 1 for idx, name in enumerate(sourceNames) if name is not None}
+            missing = [name for name in evaluator.sourceNames if name not in indexes]
+            if missing:
+                raise KeyError(f'Bands not found in {src_path}: {missing}')
+            outputs = dict()
+            try:
+                for name, dtype in zip(evaluator.names, evaluator.dtypes):
+                    profile = outputProfile(src.profile, preset, count=1, dtype=dtype.name,
+                                            nodata=np.nan if np.issubdtype(dtype, np.floating) else None)
+                    outputs[name] = rasterio.open(out_paths[name], 'w+', **profile)
+                    outputs[name].set_band_description(1, name)
+
+                def processChunk(window):
+                    if not hasattr(local, 'src'):
+                        local.src = rasterio.open(src_path)
+                        handles.append(local.src)
+                    sources = {name: local.src.read(indexes[name], window=window) for name in evaluator.sourceNames}
+                    results = evaluator.evaluate(sources)
+                    with lock:
+                        for name, data in results.items():
+                            outputs[name].write(data, 1, window=window)
+
+                windows = [Window(0, row, src.width, min(chunkRows, src.height - row)) for row in range(0, src.height, chunkRows)]
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(processChunk, windows))
+                for dst in outputs.values():
+                    factors = overviewFactors(dst.height, dst.width)
+                    if OUTPUT_PRESETS[preset]['overviews'] and factors:
+                        dst.build_overviews(factors, OVERVIEW_RESAMPLING)
+                        dst.update_tags(ns='rio_overview', resampling=OVERVIEW_RESAMPLING.name)
+            finally:
+                for dst in list(outputs.values()) + handles:
+                    dst.close()
+        return out_paths
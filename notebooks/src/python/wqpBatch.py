@@ -0,0 +1,142 @@
+import os
+import traceback
+import multiprocessing
+import pandas as pd
+
+"""
+BATCH PROCESSING OF THE WQP STATISTICS
+"""
+# GDAL block cache (MB) of each worker process
+GDAL_CACHEMAX = 256
+
+# Vector layers read by each worker process
+VECTOR_CACHE = dict()
+
+def readVector(vectorData_path):
+    import geopandas as gpd
+    if vectorData_path not in VECTOR_CACHE:
+        VECTOR_CACHE[vectorData_path] = gpd.read_file(vectorData_path)
+    return VECTOR_CACHE[vectorData_path]
+
+def runProduct(path, task, status):
+    # Statistics workflow of the WQP_Statistics notebook for a single product
+    from wqpFunctions import wqp
+    src = wqp(path)
+    src.readWQP()
+    try:
+        status['stage'] = 'statistics'
+        src.computeStatistics(readVector(task['vectorData_path']), task['nameField'], task['stats'], task['nodata'])
+        if task['method'] is None and task['minLower'] is None and task['maxUpper'] is None:
+            # The statistics are computed on the band, the crops are only used by the outlier rejection
+            return wqp.exportWQPFormatStats(src)
+        status['stage'] = 'crop'
+        src.cropRasterByFeatures(task['vectorData_path'], task['nameField'])
+        status['stage'] = 'outlierRejection'
+        src.outlierRejection(method=task['method'], minLower=task['minLower'], maxUpper=task['maxUpper'])
+        if task['out_path'] is not None:
+            status['stage'] = 'export'
+            src.mergeRasterCollectionsExport(src.raster_collection, os.path.join(task['out_path'], src.name + '.tif'))
+            src.mergeRasterCollectionsExport(src.outliers_collection, os.path.join(task['out_path'], 'outliers', src.name + '.tif'))
+        return wqp.exportWQPFormatStatsOutliers(src)
+    finally:
+        src.closeWQP()
+
+def processProduct(args):
+    """
+    Process a single product in a worker: readWQP, computeStatistics and, if
+    requested, cropRasterByFeatures and outlierRejection. Returns a dictionary
+    with the exported row or the error raised in the stage where it failed.
+    """
+    import rasterio
+    path, task = args
+    status = {'stage': 'read'}
+    try:
+        # GDAL cache of the worker (only for the processing of the product)
+        with rasterio.Env(GDAL_CACHEMAX=int(task['gdalCacheMax'])):
+            df = runProduct(path, task, status)
+        return {'path': path, 'row': df.to_dict('records')[0], 'error': None}
+    except Exception as e:
+        return {'path': path, 'row': None, 'error': {
+            'path': path,
+            'name': os.path.basename(path).split('.')[0],
+            'stage': status['stage'],
+            'exception': type(e).__name__,
+            'message': str(e),
+            'traceback': traceback.format_exc(),
+        }}
+
+class batchRun:
+    """
+    Iterable over the results of processBatch. The rows (dictionaries with the
+    exported statistics) are yielded as soon as each product is finished; the
+    failures are collected in errors and can be exported with errorReport.
+    """
+    def __init__(self, paths, task, workers):
+        self.paths = list(paths)
+        self.task = task
+        self.workers = workers
+        self.errors = []
+        self.processed = 0
+
+    def __iter__(self):
+        args = [(path, self.task) for path in self.paths]
+        if self.workers == 1:
+            for result in map(processProduct, args):
+                yield from self.collect(result)
+            return
+        with multiprocessing.Pool(self.workers) as pool:
+            for result in pool.imap_unordered(processProduct, args):
+                yield from self.collect(result)
+
+    def collect(self, result):
+        self.processed += 1
+        if result['error'] is not None:
+            self.errors.append(result['error'])
+        else:
+            yield result['row']
+
+    def toDataFrame(self):
+        # Run the batch and return all the rows in a single dataframe
+        return pd.DataFrame(list(self))
+
+    def errorReport(self, out_path=None):
+        # Failures as a dataframe (optionally saved as csv)
+        df = pd.DataFrame(self.errors, columns=['path', 'name', 'stage', 'exception', 'message', 'traceback'])
+        if out_path is not None:
+            df.to_csv(out_path, index=False)
+        return df
+
+def processBatch(paths, vectorData_path, nameField, stats, nodata, method=None, minLower=None, maxUpper=None,
+                 out_path=None, workers=None, gdalCacheMax=GDAL_CACHEMAX):
+    """
+    Run the statistics workflow of the WQP_Statistics notebook over a list of products
+    in a process pool. Without method/minLower/maxUpper only the zonal statistics are
+    exported (exportWQPFormatStats); otherwise the outlier rejection is applied and its
+    statistics are exported (exportWQPFormatStatsOutliers). If out_path is given the
+    outlier rejection rasters are saved as in the notebook.
+        paths: list of wqp GeoTIFF products
+        vectorData_path: path to the vector layer with the features (e.g. simile_laghi.shp)
+        nameField: field with the feature names
+        stats: statistics for computeStatistics
+        nodata: no data value for computeStatistics
+        workers: number of processes (default: number of cpus)
+        gdalCacheMax: GDAL cache (MB) of each worker
+    Returns a batchRun that yields the rows as the products are finished, e.g.
+        run = processBatch(paths, vector, 'Nome', stats, 0, method='IQR', minLower=0, maxUpper=100, workers=4)
+        df = run.toDataFrame()
+        run.errorReport(os.path.join(out_path, 'error_images.csv'))
+    """
+    task = {
+        'vectorData_path': vectorData_path,
+        'nameField': nameField,
+        'stats': stats,
+        'nodata': nodata,
+        'method': method,
+        'minLower': minLower,
+        'maxUpper': maxUpper,
+        'out_path': out_path,
+        'gdalCacheMax': gdalCacheMax,
+    }
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    return batchRun(paths, task, workers)
@@ -0,0 +1,159 @@
+import os
+import re
+import sqlite3
+import pandas as pd
+from wqpFunctions import wqp
+
+"""
+PRODUCT CATALOG
+"""
+class productCatalog:
+    """
+    Persistent index (SQLite) of the wqp products stored under a folder tree.
+    Each GeoTIFF is indexed by the metadata parsed by the wqp class (sensor, typology,
+    crs code and date) plus the processing level, the folder relative to the root
+    and whether it is a cropped output. The index is updated incrementally: only the
+    files whose modification time changed are parsed again.
+        db_path: path to the SQLite file storing the catalog
+        root: root folder of the products (e.g. './in/wqp')
+    """
+    COLUMNS = ['path', 'folder', 'name', 'sensor', 'typology', 'crs', 'date', 'level', 'cropped', 'mtime', 'size']
+    EXTENSIONS = ('.tif', '.tiff', '.vrt')
+
+    def __init__(self, db_path, root):
+        self.db_path = db_path
+        self.root = root
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS products (
+                path TEXT PRIMARY KEY,
+                folder TEXT,
+                name TEXT,
+                sensor TEXT,
+                typology TEXT,
+                crs TEXT,
+                date TEXT,
+                level TEXT,
+                cropped INTEGER,
+                mtime REAL,
+                size INTEGER
+            )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS products_query ON products (sensor, typology, date)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS products_folder ON products (folder, name)')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    # Metadata of a product from its path (None for the values that can not be parsed)
+    def parseProduct(self, path, mtime, size):
+        folder = os.path.relpath(os.path.dirname(path), self.root).replace(os.sep, '/')
+        if folder == '.':
+            folder = ''
+        name = os.path.basename(path).split('.')[0]
+        try:
+            product = wqp(path.replace(os.sep, '/'))
+        except (ValueError, IndexError):
+            product = None
+        date = getattr(product, 'date', None)
+        level = name.split('_')[-1] if re.match(r'^L\d+$', name.split('_')[-1]) else None
+        return (path, folder, name,
+                getattr(product, 'sensor', None),
+                getattr(product, 'typology', None),
+                getattr(product, 'crs', None),
+                date.isoformat() if date is not None else None,
+                level,
+                int(folder.split('/')[-1] == 'cropped'),
+                mtime, size)
+
+    def update(self):
+        """
+        Synchronize the catalog with the folder tree. New and modified files are
+        (re)parsed and the entries of the removed files are deleted.
+        Returns the number of added/updated and removed products.
+        """
+        indexed = dict(self.connection.execute('SELECT path, mtime FROM products'))
+        rows = []
+        found = set()
+        for root, dirs, files in os.walk(self.root):
+            for f in files:
+                if not f.lower().endswith(self.EXTENSIONS):
+                    continue
+                path = os.path.join(root, f)
+                st = os.stat(path)
+                found.add(path)
+                if indexed.get(path) != st.st_mtime:
+                    rows.append(self.parseProduct(path, st.st_mtime, st.st_size))
+        removed = [(path,) for path in indexed if path not in found]
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO products ({','.join(self.COLUMNS)}) VALUES ({','.join('?'*len(self.COLUMNS))})", rows)
+            self.connection.executemany('DELETE FROM products WHERE path = ?', removed)
+        return {'updated': len(rows), 'removed': len(removed)}
+
+    def filters(self, alias='p', sensor=None, typology=None, start=None, end=None, year=None, level=None, folder=None, cropped=None):
+        # SQL conditions for the query arguments. The sensor matches by prefix (S3 -> S3A, S3B)
+        # and the typology is case insensitive
+        where = []
+        params = []
+        if sensor is not None:
+            where.append(f'{alias}.sensor LIKE ?')
+            params.append(f'{sensor}%')
+        if typology is not None:
+            where.append(f'UPPER({alias}.typology) = UPPER(?)')
+            params.append(typology)
+        if year is not None:
+            where.append(f'{alias}.date >= ? AND {alias}.date < ?')
+            params.extend([f'{int(year)}-01-01', f'{int(year)+1}-01-01'])
+        if start is not None:
+            where.append(f'{alias}.date >= ?')
+            params.append(pd.Timestamp(start).isoformat())
+        if end is not None:
+            where.append(f'{alias}.date <= ?')
+            params.append(pd.Timestamp(end).isoformat())
+        if level is not None:
+            where.append(f'{alias}.level = ?')
+            params.append(level)
+        if folder is not None:
+            where.append(f'{alias}.folder = ?')
+            params.append(folder)
+        if cropped is not None:
+            where.append(f'{alias}.cropped = ?')
+            params.append(int(cropped))
+        return where, params
+
+    def toDataFrame(self, sql, params):
+        df = pd.read_sql_query(sql, self.connection, params=params)
+        df['date'] = pd.to_datetime(df['date'])
+        df['cropped'] = df['cropped'].astype(bool)
+        return df
+
+    def query(self, **filters):
+        """
+        Products matching the filters: sensor, typology, start, end, year, level,
+        folder (relative to the root) and cropped. e.g. query(sensor='S3', typology='chl', year=2022)
+        """
+        where, params = self.filters(**filters)
+        sql = 'SELECT * FROM products p'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return self.toDataFrame(sql + ' ORDER BY p.date', params)
+
+    def missingOutputs(self, target='cropped', **filters):
+        """
+        Products (not cropped) without a product of the same name in the target
+        subfolder of their folder. e.g. all the S3 chl maps of 2022 that lack the
+        cropped outputs: missingOutputs(sensor='S3', typology='chl', year=2022)
+        """
+        where, params = self.filters(**filters)
+        where = ['p.cropped = 0'] + where
+        sql = f'''
+            SELECT p.* FROM products p
+            WHERE {' AND '.join(where)}
+            AND NOT EXISTS (
+                SELECT 1 FROM products c
+                WHERE c.name = p.name
+                AND c.folder = CASE WHEN p.folder = '' THEN ? ELSE p.folder || '/' || ? END
+            )
+            ORDER BY p.date'''
+        return self.toDataFrame(sql, params + [target, target])
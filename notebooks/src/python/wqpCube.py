@@ -0,0 +1,101 @@
+import os
+import xml.etree.ElementTree as ET
+import rasterio
+from wqpFunctions import writeRaster
+
+"""
+MULTI-BAND PRODUCTS OF A SCENE
+"""
+# Writers of the cube of a scene: GeoTIFF (one band per target band) or NetCDF (one variable per band)
+CUBE_FORMATS = {
+    'GeoTIFF': '.tif',
+    'GeoTIFF-BigTIFF': '.tif',
+    'NetCDF4-CF': '.nc',
+}
+
+def cubeOutputPath(cwd_path, name):
+    # Cube of a S3 scene, named as the masks/oa/rrs products (e.g. S3A_IT_20190315T094218_L1)
+    sensorName = name.split('_')[0]
+    sensorDate = name.split('_')[8]
+    return os.path.join(cwd_path['out_cube'], f'{sensorName}_IT_{sensorDate}_L1')
+
+def bandSource(cube_path, band, names):
+    # GDAL source (file, band index) of a band of the cube
+    if cube_path.endswith('.nc'):
+        return f'NETCDF:"{cube_path}":{band}', 1
+    return cube_path, names.index(band) + 1
+
+def finalizeCube(cube_path, names, preset='deflate'):
+    """
+    Band descriptions (the target band names) and layout of a GeoTIFF cube written
+    by SNAP (untiled, without band names). With a preset other than plain the cube
+    is rewritten with its tiles and compression (see OUTPUT_PRESETS).
+    """
+    if cube_path.endswith('.nc'):
+        # The NetCDF variables have the band names
+        return cube_path
+    with rasterio.open(cube_path) as src:
+        if src.count != len(names):
+            raise ValueError(f'{cube_path} has {src.count} bands, expected {len(names)}: {names}')
+        profile = src.profile.copy()
+        data = src.read() if preset != 'plain' else None
+    if data is None:
+        with rasterio.open(cube_path, 'r+') as dst:
+            for idx, name in enumerate(names):
+                dst.set_band_description(idx + 1, name)
+        return cube_path
+    tmp_path = f'{cube_path}.{os.getpid()}.tmp'
+    writeRaster(tmp_path, dict(profile, driver='GTiff'), data, preset, descriptions=names)
+    os.replace(tmp_path, cube_path)
+    return cube_path
+
+def vrtXML(cube_path, band, names, vrt_path):
+    # VRT with a single band of the cube (the path of the source is relative to the VRT)
+    source, index = bandSource(cube_path, band, names)
+    with rasterio.open(source) as src:
+        width, height = src.width, src.height
+        dtype = src.dtypes[index - 1]
+        nodata = src.nodatavals[index - 1]
+        transform = src.transform
+        crs = src.crs
+        blockHeight, blockWidth = src.block_shapes[index - 1]
+    relative = not cube_path.endswith('.nc')
+    if relative:
+        source = os.path.relpath(cube_path, os.path.dirname(os.path.abspath(vrt_path)))
+    root = ET.Element('VRTDataset', rasterXSize=str(width), rasterYSize=str(height))
+    if crs is not None:
+        ET.SubElement(root, 'SRS').text = crs.to_wkt()
+    ET.SubElement(root, 'GeoTransform').text = ', '.join(repr(v) for v in transform.to_gdal())
+    vrtBand = ET.SubElement(root, 'VRTRasterBand', dataType=rasterio.dtypes._gdal_typename(dtype), band='1')
+    ET.SubElement(vrtBand, 'Description').text = band
+    if nodata is not None:
+        ET.SubElement(vrtBand, 'NoDataValue').text = repr(nodata)
+    simple = ET.SubElement(vrtBand, 'SimpleSource')
+    ET.SubElement(simple, 'SourceFilename', relativeToVRT='1' if relative else '0').text = source
+    ET.SubElement(simple, 'SourceBand').text = str(index)
+    ET.SubElement(simple, 'SourceProperties', RasterXSize=str(width), RasterYSize=str(height),
+                  DataType=rasterio.dtypes._gdal_typename(dtype), BlockXSize=str(blockWidth), BlockYSize=str(blockHeight))
+    ET.SubElement(simple, 'SrcRect', xOff='0', yOff='0', xSize=str(width), ySize=str(height))
+    ET.SubElement(simple, 'DstRect', xOff='0', yOff='0', xSize=str(width), ySize=str(height))
+    return ET.tostring(root, encoding='unicode')
+
+def splitCube(cube_path, names, band_paths):
+    """
+    Legacy layout of the outputs (one product per band in its folder, e.g.
+    out_wqp/chl, out_wqp_no_clip/tsm) as VRTs that read the bands of the cube:
+    no data is copied.
+        cube_path: cube written by SNAP (finalizeCube)
+        names: band names of the cube by band order
+        band_paths: {band name: output path without extension} (e.g. graphOutputPaths)
+    Returns {band name: VRT path}.
+    """
+    written = dict()
+    for band, out_path in band_paths.items():
+        if band not in names:
+            raise KeyError(f'Band {band} is not in {cube_path}')
+        vrt_path = out_path + '.vrt'
+        os.makedirs(os.path.dirname(vrt_path), exist_ok=True)
+        with open(vrt_path, 'w') as f:
+            f.write(vrtXML(cube_path, band, names, vrt_path))
+        written[band] = vrt_path
+    return written
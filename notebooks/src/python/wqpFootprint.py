@@ -0,0 +1,130 @@
+import os
+import json
+import numpy as np
+
+"""
+FOOTPRINT OF THE SNAP PRODUCTS
+"""
+# Maximum number of boundary points read through the geocoding (adaptive step)
+MAX_BOUNDARY_POINTS = 400
+# Latitude/longitude rasters of the products with pixel geocoding (e.g. S3 OLCI)
+LAT_LON_RASTERS = [('latitude', 'longitude'), ('lat', 'lon'), ('TP_latitude', 'TP_longitude')]
+
+def boundaryStep(width, height, maxPoints=MAX_BOUNDARY_POINTS):
+    # Step (pixels) so that the boundary has at most maxPoints points
+    return max(1, int(np.ceil(2 * (width + height) / maxPoints)))
+
+def boundaryPixels(width, height, step):
+    # Pixel centres along the four edges of the scene (clockwise from the upper left corner)
+    xs = np.append(np.arange(0, width - 1, step), width - 1) + 0.5
+    ys = np.append(np.arange(0, height - 1, step), height - 1) + 0.5
+    x = np.concatenate([xs, np.full(len(ys), xs[-1]), xs[::-1], np.full(len(ys), xs[0])])
+    y = np.concatenate([np.full(len(xs), ys[0]), ys, np.full(len(xs), ys[-1]), ys[::-1]])
+    return x, y
+
+def readEdges(raster, width, height):
+    # Pixels of the four edges of a raster with one readPixels call per edge
+    edges = []
+    for x, y, w, h in [(0, 0, width, 1), (width - 1, 0, 1, height), (0, height - 1, width, 1), (0, 0, 1, height)]:
+        data = np.zeros(w * h, dtype=np.float32)
+        raster.readPixels(x, y, w, h, data)
+        edges.append(data)
+    return np.concatenate(edges)
+
+def boundaryLatLon(product, maxPoints=MAX_BOUNDARY_POINTS):
+    """
+    Latitude and longitude (numpy arrays) of the boundary of a SNAP product. The
+    products with latitude/longitude rasters are read in bulk (whole edges); for
+    the others the geocoding is evaluated along the edges with an adaptive step.
+    """
+    width = product.getSceneRasterWidth()
+    height = product.getSceneRasterHeight()
+    for latName, lonName in LAT_LON_RASTERS:
+        lat = product.getRasterDataNode(latName)
+        lon = product.getRasterDataNode(lonName)
+        if lat is not None and lon is not None and lat.getRasterWidth() == width and lat.getRasterHeight() == height:
+            return readEdges(lat, width, height), readEdges(lon, width, height)
+    from snappy import jpy
+    PixelPos = jpy.get_type('org.esa.snap.core.datamodel.PixelPos')
+    geoCoding = product.getSceneGeoCoding()
+    x, y = boundaryPixels(width, height, boundaryStep(width, height, maxPoints))
+    lat = np.empty(len(x))
+    lon = np.empty(len(x))
+    for i in range(len(x)):
+        geoPos = geoCoding.getGeoPos(PixelPos(float(x[i]), float(y[i])), None)
+        lat[i] = geoPos.getLat()
+        lon[i] = geoPos.getLon()
+    return lat, lon
+
+def footprintBounds(lat, lon):
+    # Bounding box of the valid boundary coordinates (same keys as snapProduct.bbox)
+    valid = np.isfinite(lat) & np.isfinite(lon)
+    if not valid.any():
+        raise ValueError('The product boundary has no valid coordinates')
+    return {
+        'minLat': float(lat[valid].min()),
+        'maxLat': float(lat[valid].max()),
+        'minLon': float(lon[valid].min()),
+        'maxLon': float(lon[valid].max()),
+    }
+
+def productBounds(product, maxPoints=MAX_BOUNDARY_POINTS):
+    lat, lon = boundaryLatLon(product, maxPoints)
+    return footprintBounds(lat, lon)
+
+def intersects(bbox, bbox_prod):
+    # True if the ROI bounding box and the product footprint overlap
+    return (bbox['minLat'] < bbox_prod['maxLat'] and bbox['maxLat'] > bbox_prod['minLat'] and
+            bbox['minLon'] < bbox_prod['maxLon'] and bbox['maxLon'] > bbox_prod['minLon'])
+
+class footprintCache:
+    """
+    Footprints (bounding boxes) of the products stored in a JSON file, by product
+    path. An entry is valid while the modification time of the product does not
+    change, so the footprint of a scene is computed only once.
+        cache_path: path to the JSON file
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = dict()
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self.entries = json.load(f)
+
+    def key(self, path):
+        return os.path.abspath(path)
+
+    def get(self, path):
+        entry = self.entries.get(self.key(path))
+        if entry is None or not os.path.exists(path) or entry['mtime'] != os.path.getmtime(path):
+            return None
+        return entry['bbox']
+
+    def put(self, path, bbox_prod):
+        self.entries[self.key(path)] = {'mtime': os.path.getmtime(path), 'bbox': bbox_prod}
+
+    def save(self):
+        # Merged with the entries saved in the meantime (e.g. by other workers)
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                self.entries = dict(json.load(f), **self.entries)
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def screen(self, paths, bbox):
+        """
+        Pre-filter of a list of products: the products with a cached footprint that
+        does not intersect bbox are discarded (the products not in the cache are kept).
+        Returns the kept and the discarded paths.
+        """
+        kept = []
+        discarded = []
+        for path in paths:
+            bbox_prod = self.get(path)
+            if bbox_prod is not None and not intersects(bbox, bbox_prod):
+                discarded.append(path)
+            else:
+                kept.append(path)
+        return kept, discarded
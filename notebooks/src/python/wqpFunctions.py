@@ -1,18 +1,25 @@
 import os
 import math
-import csv
+import hashlib
+from collections import OrderedDict
 from datetime import datetime
 import numpy as np
 import pandas as pd
 import fiona
 import rasterio
-from rasterio.merge import merge
 import rasterio.mask
+from rasterio.windows import Window
 from rasterio.io import MemoryFile
-from rasterstats import zonal_stats, point_query
+from rasterio.enums import Resampling
+import rasterio.shutil
+from affine import Affine
+import rasterio.features
+import rasterio.windows
 import matplotlib.pyplot as plt
 
 class wqp:
+    # Preset of the output profile used by the writers (see OUTPUT_PRESETS)
+    outputPreset = 'plain'
 
     # Extract the metadata of the datasets    
     def __init__(self, path):
@@ -45,12 +52,19 @@ class wqp:
     # Read the datasets using rasterio
     def readWQP(self):
         self.image = rasterio.open(self.path)
+        self.array = None
+
+    # Load the first band of the dataset once and keep it in memory
+    def readBand(self):
+        if getattr(self, 'array', None) is None:
+            self.array = self.image.read(1)
+        return self.array
         
     # Close the dataset using rasterio
     def closeWQP(self):
         self.image.close()
         
-    def writeWQP(self, out_path, array):
+    def writeWQP(self, out_path, array, preset=None):
         
         # Register GDAL format drivers and configuration options with a
         # context manager.
@@ -62,11 +76,10 @@ class wqp:
             profile = self.image.profile
 
             # And then change the band count to 1, set the
-            # dtype to uint8, and specify LZW compression.
+            # dtype to float32. Tiling and compression depend on the preset.
             profile.update(
                 dtype=rasterio.float32,
                 count=1,
-                # compress='lzw'
                 )
 
             if self.typology == 'oa':
@@ -74,44 +87,89 @@ class wqp:
             else:
                 f_name = os.path.join(out_path)
 
-            with rasterio.open(f_name, 'w', **profile) as dst:
-                dst.write(array.astype(rasterio.float32), 1)
+            writeRaster(f_name, profile, array.astype(rasterio.float32), preset or self.outputPreset)
            
     
     # Compute the zonal statistics for a reference raster and polygon
     def computeStatistics(self, vectorData, nameField, stats, nodata):
         # Default stats returned by the method
-        # Use the stats documentation provided for rasterstats
-        zs_temp = zonal_stats(vectorData, self.path, stats=stats, nodata=nodata)
+        # Use the stats documentation provided for rasterstats. The statistics
+        # are computed on the band already loaded in memory (see readBand);
+        # without nodata the nodata value of the raster is excluded (as rasterstats)
+        if nodata is None:
+            nodata = self.image.nodata
+        zs_temp = zonalStatistics(self.readBand(), self.image.transform, vectorData.geometry, stats=stats, nodata=nodata)
         
         # Organize the data according to the feature
         zs = dict()
-        j = 0
-        for d in zs_temp:
-            zs[vectorData.loc[j][nameField]] = d
-            j += 1
+        for name, d in zip(vectorData[nameField].values, zs_temp):
+            zs[name] = d
             
         self.stats = zs
         
 
-    # Extract point data from the reference product for single band raster
-    def extractSamplePoints(self, vectorData):
-        obs = []
-        for i, point in vectorData.iterrows():
-            n = point[0] 
-            x = point[2].xy[0][0]
-            y = point[2].xy[1][0]
-            row, col = self.image.index(x,y)
-            try:
-                value = self.image.read(1)[row,col]
-                o = [n, x,y,row,col,value]
-                obs.append(o)
-            except:
-                print(x,',',y,' coordinates are out of the image')
-        
-        df = pd.DataFrame(obs, columns = ['id','x','y','row','col',self.typology])
-        
+    # Extract point data from the reference product. Default sampled band: 1.
+    # All the points are transformed to row/col at once and the bands are read
+    # only for the window covering the points inside the image.
+    def extractSamplePoints(self, vectorData, bands=1):
+        if isinstance(bands, int):
+            bands = [bands]
+        ids = vectorData.iloc[:,0].values
+        x = vectorData.geometry.x.values
+        y = vectorData.geometry.y.values
+
+        # Pixel coordinates for all the points (same rounding as image.index)
+        cols, rows = ~self.image.transform * (x, y)
+        rows = np.floor(rows).astype(int)
+        cols = np.floor(cols).astype(int)
+        inside = (rows>=0) & (rows<self.image.height) & (cols>=0) & (cols<self.image.width)
+
+        values = np.full((len(bands), len(ids)), np.nan)
+        if inside.any():
+            rowMin, rowMax = rows[inside].min(), rows[inside].max()
+            colMin, colMax = cols[inside].min(), cols[inside].max()
+            window = Window(colMin, rowMin, colMax-colMin+1, rowMax-rowMin+1)
+            data = self.image.read(bands, window=window)
+            values[:,inside] = data[:, rows[inside]-rowMin, cols[inside]-colMin]
+
+        df = pd.DataFrame({'id':ids,'x':x,'y':y,'row':rows,'col':cols,'outOfBounds':~inside})
+        if len(bands) == 1:
+            df[self.typology] = values[0]
+        else:
+            for b, v in zip(bands, values):
+                df['{}_{}'.format(self.typology,b)] = v
+
         self.samplePoint = df
+
+    # Sample several products (wqp objects or paths) in one call. Returns a
+    # tidy dataframe with one row per point, product and band.
+    def sampleRasters(sources, vectorData, bands=1):
+        if isinstance(bands, int):
+            bands = [bands]
+        arr = []
+        for src in sources:
+            opened = False
+            if not isinstance(src, wqp):
+                src = wqp(src)
+                src.readWQP()
+                opened = True
+            src.extractSamplePoints(vectorData, bands)
+            values = src.samplePoint.drop(columns=['id','x','y','row','col','outOfBounds'])
+            for b, col in zip(bands, values.columns):
+                df = src.samplePoint[['id','x','y','row','col','outOfBounds']].copy()
+                df['name'] = src.name
+                df['sensor'] = src.sensor
+                df['typology'] = src.typology
+                df['date'] = getattr(src, 'date', None)
+                df['band'] = b
+                df['value'] = values[col].values
+                arr.append(df)
+            if opened:
+                src.closeWQP()
+
+        if len(arr) == 0:
+            return pd.DataFrame(columns=['id','x','y','row','col','outOfBounds','name','sensor','typology','date','band','value'])
+        return pd.concat(arr, ignore_index=True)
         
     def organizeWQPEstimates(d_stats):
         # Organize the WQP descriptive statistics in an structure suitable to be exported as a dataframe
@@ -121,6 +179,13 @@ class wqp:
                 d['{}_{}'.format(key_stat,key_feature)] = d_stats[key_feature][key_stat]
         return d
     
+    # Statistics workflow over many products in a process pool (see wqpBatch.processBatch), e.g.
+    #   run = wqp.process_batch(paths, vector, 'count min max mean std', method='IQR', workers=4)
+    #   df = run.toDataFrame()
+    def process_batch(paths, vectorData_path, stats, method=None, workers=None, nameField='Nome', nodata=None, **kwargs):
+        from wqpBatch import processBatch
+        return processBatch(paths, vectorData_path, nameField, stats, nodata, method=method, workers=workers, **kwargs)
+
     def exportWQPFormatStats(src):
         d = wqp.organizeWQPEstimates(src.stats)
         stats_keys = list(d.keys())
@@ -165,8 +230,22 @@ class wqp:
     """
     DEFINE THE PROCESSING AND STORING FUNCTIONS
     """
+    # Band of a crop by its raster band index (crops may hold only some of the bands).
+    # As in the original saveMaskedImage, band 0 is the last band of the raster.
+    def cropBand(self, NameFeature, band):
+        count = self.image.count
+        if not 0 <= band <= count:
+            raise ValueError(f'Band {band} is not in the raster (bands 1-{count})')
+        band = band if band > 0 else count
+        indexes = self.crops[NameFeature].get('indexes')
+        if indexes is None:
+            return self.crops[NameFeature]['crop'][band-1]
+        if band not in indexes:
+            raise ValueError(f'Band {band} was not read by cropRasterByFeatures (bands read: {list(indexes)})')
+        return self.crops[NameFeature]['crop'][indexes.index(band)]
+
     # Single feature crop save. Default saved band: 0.
-    def saveMaskedImage(self,out_path,NameFeature, band=0):
+    def saveMaskedImage(self,out_path,NameFeature, band=0, preset=None):
         profile = self.image.profile.copy()
         profile.update({
                 'dtype': 'float32',
@@ -176,31 +255,21 @@ class wqp:
                 'transform': self.crops[NameFeature]['transform']
             })  
 
-        with rasterio.open(out_path, 'w', **profile) as dst:
-            dst.write_band(1, self.crops[NameFeature]['crop'][band-1])
+        writeRaster(out_path, profile, self.cropBand(NameFeature, band), preset or self.outputPreset)
     
     
-    def saveMaskedImageMultiband(self,out_path,NameFeature):
-        n_bands = self.crops[NameFeature]['crop'].shape[0]
-        arr_bands = np.linspace(1,n_bands,n_bands)
+    def saveMaskedImageMultiband(self,out_path,NameFeature, preset=None):
+        crop = self.crops[NameFeature]['crop']
         profile = self.image.profile.copy()
-        if n_bands == 1:
-            count = 1
-        else:
-            count = self.crops[NameFeature]['crop'].shape[1]
         profile.update({
                 'dtype': 'float32',
-                'height': self.crops[NameFeature]['crop'][0].shape[0],
-                'width': self.crops[NameFeature]['crop'][0].shape[1],
-                'count': count,
+                'height': crop[0].shape[0],
+                'width': crop[0].shape[1],
+                'count': crop.shape[0],
                 'transform': self.crops[NameFeature]['transform']
             })  
 
-        with rasterio.open(out_path, 'w', **profile) as dst:
-            if n_bands == 1:
-                dst.write_band(1, self.crops[NameFeature]['crop'][0])
-            else:
-                dst.write(self.crops[NameFeature]['crop'],arr_bands)
+        writeRaster(out_path, profile, crop, preset or self.outputPreset)
         
     """
     IMPORT THE INDEPENDENT LAYERS FOR THE LAKES
@@ -214,19 +283,6 @@ class wqp:
                 shapes[feature['properties'][nameField]]["geometry"] = [feature["geometry"]]
         return shapes
 
-#     """
-#     CREATE DATASET
-#     """
-#     def create_dataset(data, crs, transform):
-#         # Receives a 3D array, a transform and a crs to create a rasterio dataset
-
-#         memfile = MemoryFile()
-#         dataset = memfile.open(driver='GTiff', height=data.shape[0], width=data.shape[1], count=1, crs=crs, 
-#                                transform=transform, dtype=data.dtype)
-#         dataset.write(data)
-
-#         return dataset
-     
     """
     METHODS FOR DETECTING OUTLIERS THROUGH THRESHOLDS
     """
@@ -276,24 +332,22 @@ class wqp:
                 lowerBound = bounds['lowerBound']
                 upperBound = bounds['upperBound']
                 
-                # Identify the number of outliers for each threshold
-                raster = self.crops[key]['crop'].copy()
-                countTotal = np.count_nonzero(~np.isnan(raster))
-                # Extract the outliers values to the corresponding thresholds
-                raster[(raster<=lowerBound) | (raster>=upperBound)] = np.nan 
-                countValid = np.count_nonzero(~np.isnan(raster))
+                # Identify the number of outliers for each threshold with a single mask
+                # computation over the crop (NaN values are never inside the bounds)
+                raster = self.crops[key]['crop']
+                finite = ~np.isnan(raster)
+                inside = (raster>lowerBound) & (raster<upperBound)
+                # Outliers: values out of the bounds (including the bounds) different from 0
+                outside = finite & ~inside & (raster!=0)
+                countTotal = np.count_nonzero(finite)
+                countValid = np.count_nonzero(inside)
                 if (countValid>0):
                     percValid = countValid / countTotal
                 else:
                     percValid = 0
-                
-                # Extract outliers from the crop raster
-                outliers = self.crops[key]['crop'].copy()
-                outliers[outliers==0] = np.nan
-    #             outliers[(outliers>=lowerBound) | (outliers<=upperBound)] = np.nan  
-                outliers[(outliers>lowerBound) & (outliers<upperBound)] = np.nan  
-                countLower = np.count_nonzero(outliers<lowerBound)
-                countUpper = np.count_nonzero(outliers>upperBound)
+                outliersValues = raster[outside]
+                countLower = np.count_nonzero(outliersValues<lowerBound)
+                countUpper = np.count_nonzero(outliersValues>upperBound)
 
                 # Organize results in dictionary
                 orDict[key]['Method'] = method
@@ -309,10 +363,9 @@ class wqp:
                 else:
                     orDict[key]['percOutliers'] = 0
 
-                # Save raster with no outliers
-                raster_collection[key] = self.create_dataset(raster[0],self.crops[key]['transform'])
-                outliers_collection[key] = self.create_dataset(outliers[0],self.crops[key]['transform'])
-                del raster, outliers
+                # Raster with no outliers and raster of the outliers as masked views of the crop
+                raster_collection[key] = rasterLayer(np.ma.masked_array(raster[0], mask=~inside[0]), self.crops[key]['transform'], self.image.crs)
+                outliers_collection[key] = rasterLayer(np.ma.masked_array(raster[0], mask=~outside[0]), self.crops[key]['transform'], self.image.crs)
             else:
                 print(f'Missing Stats for Lake {key}')
         self.raster_collection = raster_collection
@@ -323,20 +376,33 @@ class wqp:
     """
     MERGE RASTER COLLECTIONS
     """
-    def mergeRasterCollectionsExport(self, raster_collection, out_path):
+    # Mosaic of the layers of a collection (dict of rasterLayer, (array, transform) or
+    # datasets). Overlapping pixels take the value of the first layer in the order
+    # (default: MERGE_ORDER, the other keys are not merged). stream: write the layers
+    # window by window into the output file instead of building the mosaic in memory.
+    def mergeRasterCollectionsExport(self, raster_collection, out_path, order=None, stream=False, preset=None):
         if (len(raster_collection)>0):
-            raster_col_lst = []
-            for x in ['Lugano','Como','Maggiore']:
-                if x in list(raster_collection.keys()):
-                    raster_col_lst.append(raster_collection[x])
-            merged, transf = merge(raster_col_lst)
-            merged[0][merged[0]==0]=np.nan
-            self.saveMergedImage(out_path,merged[0],transf)
+            if order is None:
+                order = MERGE_ORDER
+            layers = [asRasterLayer(raster_collection[x]) for x in order if x in raster_collection]
+            if stream:
+                transf, shape = mosaicGrid(layers)
+                profile = self.image.profile.copy()
+                profile.update({
+                        'dtype': 'float32',
+                        'height': shape[0],
+                        'width': shape[1],
+                        'transform': transf
+                 })
+                writeMosaic(layers, out_path, profile, preset or self.outputPreset)
+            else:
+                merged, transf = mosaicLayers(layers)
+                self.saveMergedImage(out_path,zeroToNaN(merged),transf,preset)
 
     """
     SAVED MERGED COLLECTION
     """
-    def saveMergedImage(self, out_path, data, transf):
+    def saveMergedImage(self, out_path, data, transf, preset=None):
         profile = self.image.profile.copy()
         profile.update({
                 'dtype': 'float32',
@@ -345,28 +411,30 @@ class wqp:
                 'transform': transf
          })  
 
-        with rasterio.open(out_path, 'w', **profile) as dst:
-            dst.write_band(1, data)
+        writeRaster(out_path, profile, data, preset or self.outputPreset)
     
     
     """
     CROP RASTER LAYER BY FEATURES
     """
-    def cropRasterByFeatures(self, vectorData_path, nameField, band=None):
-        
+    # band: band index or list of band indexes to read (default: all the bands)
+    # lazy: if True, the crops are read from the raster window on first access
+    def cropRasterByFeatures(self, vectorData_path, nameField, band=None, cache=None, lazy=False):
+        # The rasterized features are shared by all the images on the same grid
+        if cache is None:
+            cache = MASK_CACHE
+        if isinstance(band, int):
+            band = [band]
         crops = dict()
-        shapes = wqp.importVector(vectorData_path, nameField)
-        for key in shapes:
-            crop_shape = dict()
-            featureName = key
-            featureGeometry = shapes[key]['geometry']
-            try: 
-                cropped_image, cropped_transform = rasterio.mask.mask(self.image, featureGeometry, crop=True, filled=True, all_touched=False, nodata=np.nan)
-                crop_shape['crop'] = cropped_image
-                crop_shape['transform'] = cropped_transform
-                crops[key] = crop_shape
-            except:
+        masks = cache.getMasks(vectorData_path, nameField, self.image)
+        for key in masks:
+            if masks[key] is None:
                 print(f"Lake {key} does not overlay the raster layer")
+                continue
+            crop_shape = lazyCrop(self.image, masks[key], band)
+            if not lazy:
+                crop_shape.load()
+            crops[key] = crop_shape
         self.crops = crops
 
     """
@@ -382,6 +450,609 @@ class wqp:
 
         return dataset
     
+"""
+CACHE OF THE RASTERIZED FEATURES
+"""
+class featureMaskCache:
+    """
+    LRU cache of the features of a vector file rasterized on a raster grid.
+    The entries are keyed by (vector file, name field, CRS, transform, shape) and
+    store for each feature the boolean mask (True inside the feature), the crop
+    window (col_off, row_off, width, height) and the transform of the window.
+    Features that do not overlay the grid are stored as None.
+        maxsize: number of grids kept in memory
+        cacheDir: optional folder to persist the masks as .npz files
+    """
+    def __init__(self, maxsize=32, cacheDir=None):
+        self.maxsize = maxsize
+        self.cacheDir = cacheDir
+        self.entries = OrderedDict()
+
+    def key(self, vectorData_path, nameField, image):
+        vectorData_path = os.path.abspath(vectorData_path)
+        return (vectorData_path, os.path.getmtime(vectorData_path), nameField,
+                image.crs.to_wkt() if image.crs else None, tuple(image.transform)[:6], image.shape)
+
+    def getMasks(self, vectorData_path, nameField, image):
+        key = self.key(vectorData_path, nameField, image)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        masks = self.readMasks(key)
+        if masks is None:
+            masks = self.buildMasks(vectorData_path, nameField, image)
+            self.writeMasks(key, masks)
+        self.entries[key] = masks
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return masks
+
+    def buildMasks(self, vectorData_path, nameField, image):
+        masks = dict()
+        shapes = wqp.importVector(vectorData_path, nameField)
+        for key in shapes:
+            try:
+                outside, transform, window = rasterio.mask.raster_geometry_mask(image, shapes[key]['geometry'], crop=True, all_touched=False)
+            except ValueError:
+                masks[key] = None
+                continue
+            masks[key] = {
+                'mask': ~outside,
+                'window': (int(window.col_off), int(window.row_off), int(window.width), int(window.height)),
+                'transform': transform,
+            }
+        return masks
+
+    def cachePath(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cacheDir, f'masks_{digest}.npz')
+
+    def readMasks(self, key):
+        if self.cacheDir is None or not os.path.exists(self.cachePath(key)):
+            return None
+        masks = dict()
+        with np.load(self.cachePath(key)) as data:
+            for i, name in enumerate(data['names'].tolist()):
+                if f'mask_{i}' in data:
+                    masks[name] = {
+                        'mask': data[f'mask_{i}'],
+                        'window': tuple(int(v) for v in data[f'window_{i}']),
+                        'transform': Affine(*data[f'transform_{i}']),
+                    }
+                else:
+                    masks[name] = None
+        return masks
+
+    def writeMasks(self, key, masks):
+        if self.cacheDir is None:
+            return
+        os.makedirs(self.cacheDir, exist_ok=True)
+        arrays = {'names': np.array(list(masks.keys()))}
+        for i, name in enumerate(masks):
+            if masks[name] is not None:
+                arrays[f'mask_{i}'] = masks[name]['mask']
+                arrays[f'window_{i}'] = np.array(masks[name]['window'])
+                arrays[f'transform_{i}'] = np.array(tuple(masks[name]['transform'])[:6])
+        np.savez_compressed(self.cachePath(key), **arrays)
+
+    def clear(self):
+        self.entries.clear()
+
+"""
+RASTER LAYERS
+"""
+# Lakes merged by mergeRasterCollectionsExport, by precedence in the overlaps
+MERGE_ORDER = ['Lugano', 'Como', 'Maggiore']
+
+class rasterLayer:
+    """
+    2D array (plain or masked, NaN or masked values are no data) with its transform
+    and CRS. The rasterio dataset is only created when requested with toDataset.
+    """
+    def __init__(self, array, transform, crs=None):
+        self.array = array
+        self.transform = transform
+        self.crs = crs
+        self.dataset = None
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    # Plain float array with NaN for the masked values
+    def filled(self, value=np.nan):
+        if np.ma.isMaskedArray(self.array):
+            return self.array.astype(np.float32).filled(value)
+        return self.array
+
+    # In memory rasterio dataset (GTiff) with the filled array
+    def toDataset(self):
+        if self.dataset is None:
+            data = self.filled()
+            memfile = MemoryFile()
+            dataset = memfile.open(driver='GTiff', height=data.shape[0], width=data.shape[1], count=1, crs=self.crs,
+                                   transform=self.transform, dtype=data.dtype)
+            dataset.write(data,1)
+            self.dataset = dataset
+        return self.dataset
+
+def asRasterLayer(layer):
+    # Accept rasterLayer objects, (array, transform) tuples and rasterio datasets
+    if isinstance(layer, rasterLayer):
+        return layer
+    if isinstance(layer, tuple):
+        return rasterLayer(layer[0], layer[1])
+    return rasterLayer(layer.read(1), layer.transform, layer.crs)
+
+"""
+OUTPUT PROFILES
+"""
+# GeoTIFF creation options of the presets used by the wqp writers.
+# plain: untiled and uncompressed (the tiles and compression of the source profile are dropped)
+# deflate/zstd: 256x256 tiles, compression and predictor (3 for floats, 2 for integers)
+# cog: deflate tiles with internal overviews, written with the cloud optimized layout
+OUTPUT_PRESETS = {
+    'plain': {'tiled': False, 'compress': None, 'overviews': False},
+    'deflate': {'tiled': True, 'compress': 'deflate', 'overviews': False},
+    'zstd': {'tiled': True, 'compress': 'zstd', 'overviews': False},
+    'cog': {'tiled': True, 'compress': 'deflate', 'overviews': True},
+}
+BLOCK_SIZE = 256
+OVERVIEW_RESAMPLING = Resampling.average
+
+def outputProfile(profile, preset='plain', **updates):
+    # Copy of a rasterio profile with the creation options of the preset
+    if preset not in OUTPUT_PRESETS:
+        raise ValueError(f'Select one of the available presets: {list(OUTPUT_PRESETS.keys())}')
+    options = OUTPUT_PRESETS[preset]
+    profile = dict(profile)
+    profile.update(updates)
+    for key in ['tiled', 'blockxsize', 'blockysize', 'compress', 'predictor']:
+        profile.pop(key, None)
+    if options['tiled']:
+        profile.update({'tiled': True, 'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE})
+    if options['compress'] is not None:
+        profile['compress'] = options['compress']
+        profile['predictor'] = 3 if np.issubdtype(np.dtype(profile['dtype']), np.floating) else 2
+    return profile
+
+def overviewFactors(height, width):
+    # Decimation factors until the overview fits in a single block
+    factors = []
+    f = 2
+    while max(height, width) / f >= BLOCK_SIZE / 2:
+        factors.append(f)
+        f *= 2
+    return factors
+
+def writeRaster(out_path, profile, data, preset='plain', descriptions=None):
+    """
+    Write a 2D (single band) or 3D array into a GeoTIFF with the options of the preset.
+    For the 'cog' preset the raster and its overviews are built in memory and copied
+    to the output with the overviews and tiles at the beginning of the file.
+    descriptions: band names (optional)
+    """
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    profile = outputProfile(profile, preset, count=data.shape[0])
+    if not OUTPUT_PRESETS[preset]['overviews']:
+        with rasterio.open(out_path, 'w', **profile) as dst:
+            dst.write(data)
+            for idx, description in enumerate(descriptions or []):
+                dst.set_band_description(idx + 1, description)
+        return
+
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as tmp:
+            tmp.write(data)
+            for idx, description in enumerate(descriptions or []):
+                tmp.set_band_description(idx + 1, description)
+            factors = overviewFactors(tmp.height, tmp.width)
+            if factors:
+                tmp.build_overviews(factors, OVERVIEW_RESAMPLING)
+                tmp.update_tags(ns='rio_overview', resampling=OVERVIEW_RESAMPLING.name)
+        with memfile.open() as tmp:
+            options = {key: profile[key] for key in ['tiled', 'blockxsize', 'blockysize', 'compress', 'predictor']}
+            rasterio.shutil.copy(tmp, out_path, driver='GTiff', copy_src_overviews=True, **options)
+
+"""
+MOSAIC OF RASTER LAYERS
+"""
+def mosaicGrid(layers):
+    # Union grid (transform, shape) of layers sharing the same pixel size
+    a, e = layers[0].transform.a, layers[0].transform.e
+    for layer in layers:
+        if not (np.isclose(layer.transform.a, a) and np.isclose(layer.transform.e, e)):
+            raise ValueError('The layers of the mosaic must have the same resolution')
+    left = min(layer.transform.c for layer in layers)
+    top = max(layer.transform.f for layer in layers)
+    right = max(layer.transform.c + layer.shape[1]*a for layer in layers)
+    bottom = min(layer.transform.f + layer.shape[0]*e for layer in layers)
+    shape = (int(round((bottom-top)/e)), int(round((right-left)/a)))
+    return Affine(a, 0, left, 0, e, top), shape
+
+def layerWindow(layer, transform):
+    # Position of the layer in the mosaic grid
+    row_off = int(round((layer.transform.f - transform.f)/transform.e))
+    col_off = int(round((layer.transform.c - transform.c)/transform.a))
+    return Window(col_off, row_off, layer.shape[1], layer.shape[0])
+
+def fillFirst(region, data):
+    # Copy the valid values of data where the region is still empty (first layer wins)
+    valid = ~np.isnan(data) & np.isnan(region)
+    region[valid] = data[valid]
+
+def zeroToNaN(data):
+    # Zero values of a mosaic are no data (set once all the layers are merged)
+    data[data==0] = np.nan
+    return data
+
+def mosaicLayers(layers):
+    """
+    Build the mosaic of a list of rasterLayer objects in a preallocated array.
+    Returns the float32 mosaic (NaN for no data) and its transform.
+    """
+    transform, shape = mosaicGrid(layers)
+    mosaic = np.full(shape, np.nan, dtype=np.float32)
+    for layer in layers:
+        w = layerWindow(layer, transform)
+        fillFirst(mosaic[w.row_off:w.row_off+w.height, w.col_off:w.col_off+w.width], layer.filled())
+    return mosaic, transform
+
+def writeMosaic(layers, out_path, profile, preset='plain'):
+    """
+    Stream a list of rasterLayer objects into a single band GeoTIFF. Each layer is
+    written into its window of the output (profile defines the mosaic grid), so
+    only one layer window is held in memory at a time. Zero values are set to NaN
+    block by block once all the layers are merged (as in
+    mergeRasterCollectionsExport), so a zero of the first layer is not replaced by
+    a later layer. With a tiled preset the mosaic is staged in an uncompressed
+    file (with the overviews of 'cog') and copied once to the output with the
+    compression and layout of the preset.
+    """
+    profile = outputProfile(profile, preset, count=1, dtype='float32', nodata=np.nan)
+    options = {key: profile[key] for key in ['tiled', 'blockxsize', 'blockysize', 'compress', 'predictor'] if key in profile}
+    staged = OUTPUT_PRESETS[preset]['tiled']
+    stage_path = f'{out_path}.{os.getpid()}.tmp' if staged else out_path
+    stage_profile = {key: value for key, value in profile.items() if key not in ('compress', 'predictor')}
+    try:
+        with rasterio.open(stage_path, 'w+', **stage_profile) as dst:
+            for layer in layers:
+                w = layerWindow(layer, dst.transform)
+                region = dst.read(1, window=w)
+                fillFirst(region, layer.filled().astype(np.float32))
+                dst.write_band(1, region, window=w)
+            for ij, w in dst.block_windows(1):
+                dst.write_band(1, zeroToNaN(dst.read(1, window=w)), window=w)
+            factors = overviewFactors(dst.height, dst.width)
+            if OUTPUT_PRESETS[preset]['overviews'] and factors:
+                dst.build_overviews(factors, OVERVIEW_RESAMPLING)
+                dst.update_tags(ns='rio_overview', resampling=OVERVIEW_RESAMPLING.name)
+        if staged:
+            rasterio.shutil.copy(stage_path, out_path, driver='GTiff', copy_src_overviews=True, **options)
+    finally:
+        if staged and os.path.exists(stage_path):
+            os.remove(stage_path)
+
+class lazyCrop(dict):
+    """
+    Crop of a raster by a feature, with the same items used by wqp.crops
+    ('crop', 'transform' and 'indexes' of the bands read). Only the window
+    of the feature is read and the 'crop' item is materialized on first
+    access, so the raster must be open until then.
+    """
+    def __init__(self, image, featureMask, indexes=None):
+        super().__init__(transform=featureMask['transform'], indexes=indexes)
+        self.image = image
+        self.featureMask = featureMask
+
+    def __missing__(self, key):
+        if key != 'crop':
+            raise KeyError(key)
+        return self.load()
+
+    def load(self):
+        # Read the window of the feature (once) and return the crop
+        if 'crop' not in self:
+            data = self.image.read(indexes=self['indexes'], window=Window(*self.featureMask['window']), masked=True)
+            self['crop'] = np.where(self.featureMask['mask'] & ~np.ma.getmaskarray(data), data.data, np.nan)
+        return self['crop']
+
+# Default cache used by wqp.cropRasterByFeatures
+MASK_CACHE = featureMaskCache()
+
+"""
+ZONAL STATISTICS
+"""
+# Statistics supported by zonalStatistics (same names as rasterstats)
+# (variety: number of distinct values, as unique)
+ZONAL_STATS = ['min', 'max', 'mean', 'count', 'sum', 'std', 'median', 'majority', 'minority', 'unique', 'variety', 'range', 'nodata', 'nan']
+DEFAULT_ZONAL_STATS = ['count', 'min', 'max', 'mean']
+# Keys of the outlier rejection statistics (outlierRejection) in their order
+OUTLIER_STATS = ['Method', 'lowerBound', 'upperBound', 'countLower', 'countUpper', 'countValid', 'countTotal', 'percValid', 'percOutliers']
+
+def zonalStatsOrder(stats):
+    # Key order of the dictionaries of zonalStatistics (percentiles after range, nodata and nan last)
+    stats = parseStats(stats)
+    ordered = [s for s in ZONAL_STATS if s in stats and s not in ('nodata', 'nan')]
+    ordered += [s for s in stats if s.startswith('percentile_')]
+    return ordered + [s for s in ('nodata', 'nan') if s in stats]
+
+def parseStats(stats):
+    # Accept the stats as a space separated string or a list
+    if stats is None:
+        stats = DEFAULT_ZONAL_STATS
+    elif isinstance(stats, str):
+        stats = stats.split()
+    stats = list(stats)
+    for s in stats:
+        if s not in ZONAL_STATS and not s.startswith('percentile_'):
+            raise ValueError(f'Statistic {s} is not supported. Select one of {ZONAL_STATS} or percentile_q')
+    return stats
+
+def geometryWindow(geometry, transform, shape):
+    # Pixel window (row_off, col_off, height, width) covering the bounds of the geometry
+    left, bottom, right, top = rasterio.features.bounds(geometry)
+    cols, rows = ~transform * (np.array([left, right, left, right]), np.array([top, top, bottom, bottom]))
+    row0 = int(max(np.floor(rows.min()), 0))
+    row1 = int(min(np.ceil(rows.max()), shape[0]))
+    col0 = int(max(np.floor(cols.min()), 0))
+    col1 = int(min(np.ceil(cols.max()), shape[1]))
+    return row0, col0, max(row1-row0, 0), max(col1-col0, 0)
+
+def interpolatedPercentile(sortedValues, starts, counts, q):
+    # Linear interpolation between the closest ranks (same as np.percentile)
+    pos = (q/100) * (counts-1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    vlo = sortedValues[starts+lo]
+    vhi = sortedValues[starts+hi]
+    return vlo + (vhi-vlo) * (pos-lo)
+
+def zonalStatistics(array, transform, geometries, stats=None, nodata=None, all_touched=False):
+    """
+    Compute the zonal statistics of a 2D array for several geometries in a single pass.
+    Each geometry is rasterized once over its bounding window, the valid pixels of
+    all the zones are gathered in one array and the statistics are computed with
+    bincount and sorted segment reductions. The output is a list of dictionaries
+    (one per geometry) with the same layout returned by rasterstats.zonal_stats.
+        array: 2D numpy array aligned to the transform
+        transform: affine transform of the array
+        geometries: iterable of shapely or GeoJSON-like geometries
+        stats: list or space separated string of statistics
+        nodata: value excluded from the statistics (NaN values are always excluded)
+    """
+    stats = parseStats(stats)
+    percentiles = [s for s in stats if s.startswith('percentile_')]
+    isFloat = np.issubdtype(array.dtype, np.floating)
+
+    zones = []
+    values = []
+    nodataCount = []
+    nanCount = []
+    n = 0
+    for i, geometry in enumerate(geometries):
+        n += 1
+        row0, col0, height, width = geometryWindow(geometry, transform, array.shape)
+        if height == 0 or width == 0:
+            nodataCount.append(0)
+            nanCount.append(0)
+            continue
+        sub = array[row0:row0+height, col0:col0+width]
+        inside = rasterio.features.rasterize(
+            [(geometry, 1)], out_shape=(height, width), fill=0, dtype='uint8', all_touched=all_touched,
+            transform=rasterio.windows.transform(rasterio.windows.Window(col0, row0, width, height), transform)
+        ).astype(bool)
+        zoneValues = sub[inside]
+        isNodata = np.zeros(zoneValues.shape, dtype=bool) if nodata is None else (zoneValues == nodata)
+        isNan = np.isnan(zoneValues) if isFloat else np.zeros(zoneValues.shape, dtype=bool)
+        nodataCount.append(np.count_nonzero(isNodata))
+        nanCount.append(np.count_nonzero(isNan))
+        zoneValues = zoneValues[~(isNodata | isNan)]
+        values.append(zoneValues)
+        zones.append(np.full(zoneValues.shape, i, dtype=np.int64))
+
+    if len(values) > 0:
+        values = np.concatenate(values).astype(np.float64)
+        zones = np.concatenate(zones)
+    else:
+        values = np.zeros(0)
+        zones = np.zeros(0, dtype=np.int64)
+
+    # Single pass reductions for all the zones
+    counts = np.bincount(zones, minlength=n)
+    sums = np.bincount(zones, weights=values, minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        stds = np.sqrt(np.bincount(zones, weights=(values - means[zones])**2, minlength=n) / counts)
+    # Sort the values inside each zone (zones are already contiguous)
+    order = np.lexsort((values, zones))
+    sortedValues = values[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+    has = counts > 0
+    mins = np.full(n, np.nan)
+    maxs = np.full(n, np.nan)
+    mins[has] = sortedValues[starts[has]]
+    maxs[has] = sortedValues[starts[has] + counts[has] - 1]
+    pct = dict()
+    for p in set(percentiles + (['percentile_50'] if 'median' in stats else [])):
+        pct[p] = np.full(n, np.nan)
+        pct[p][has] = interpolatedPercentile(sortedValues, starts[has], counts[has], float(p.split('_')[1]))
+    if any(s in stats for s in ('majority', 'minority', 'unique', 'variety')):
+        # Runs of equal values inside each zone (value counts of rasterstats)
+        sortedZones = zones[order]
+        newValue = np.ones(sortedValues.shape, dtype=bool)
+        newValue[1:] = (sortedValues[1:] != sortedValues[:-1]) | (sortedZones[1:] != sortedZones[:-1])
+        runStarts = np.flatnonzero(newValue)
+        runZones = sortedZones[runStarts]
+        runValues = sortedValues[runStarts]
+        runCounts = np.diff(np.append(runStarts, len(sortedValues)))
+        uniques = np.bincount(runZones, minlength=n)
+        # Most (least) frequent value of each zone, the smallest one on ties
+        majority = np.full(n, np.nan)
+        minority = np.full(n, np.nan)
+        if len(runStarts) > 0:
+            first = np.ones(len(runStarts), dtype=bool)
+            byMax = np.lexsort((runValues, -runCounts, runZones))
+            first[1:] = runZones[byMax][1:] != runZones[byMax][:-1]
+            majority[runZones[byMax][first]] = runValues[byMax][first]
+            byMin = np.lexsort((runValues, runCounts, runZones))
+            first[1:] = runZones[byMin][1:] != runZones[byMin][:-1]
+            minority[runZones[byMin][first]] = runValues[byMin][first]
+
+    zs = []
+    for i in range(n):
+        if counts[i] == 0:
+            d = {stat: None for stat in stats}
+            if 'count' in stats:
+                d['count'] = 0
+        else:
+            d = dict()
+            if 'min' in stats:
+                d['min'] = float(mins[i])
+            if 'max' in stats:
+                d['max'] = float(maxs[i])
+            if 'mean' in stats:
+                d['mean'] = float(means[i])
+            if 'count' in stats:
+                d['count'] = int(counts[i])
+            if 'sum' in stats:
+                d['sum'] = float(sums[i])
+            if 'std' in stats:
+                d['std'] = float(stds[i])
+            if 'median' in stats:
+                d['median'] = float(pct['percentile_50'][i])
+            if 'majority' in stats:
+                d['majority'] = float(majority[i])
+            if 'minority' in stats:
+                d['minority'] = float(minority[i])
+            if 'unique' in stats:
+                d['unique'] = int(uniques[i])
+            if 'variety' in stats:
+                d['variety'] = int(uniques[i])
+            if 'range' in stats:
+                d['range'] = float(maxs[i] - mins[i])
+            for p in percentiles:
+                d[p] = float(pct[p][i])
+        if 'nodata' in stats:
+            d['nodata'] = float(nodataCount[i])
+        if 'nan' in stats:
+            d['nan'] = float(nanCount[i])
+        zs.append(d)
+
+    return zs
+
+"""
+STATISTICS ACCUMULATOR
+"""
+class statsAccumulator:
+    """
+    Collect the exported statistics of many products in preallocated typed columns
+    and build a single table at the end (instead of one dataframe per product).
+    The schema is fixed by the statistics and the feature names, with the columns
+    of exportWQPFormatStats/exportWQPFormatStatsOutliers in the key order of
+    zonalStatistics/outlierRejection (whatever the order of stats), so the rows
+    can be appended to the csv files of appendStatsFile.
+        stats: list of statistics (or space separated string), e.g. the stats of
+               computeStatistics or the keys of the outlier rejection statistics
+        features: names of the features (e.g. ['Lugano','Como','Maggiore'])
+        capacity: initial number of rows (the columns grow by doubling)
+    """
+    META_COLUMNS = ['name', 'path', 'sensor', 'typology', 'crs', 'date']
+    TEXT_STATS = ['Method']
+    INTEGER_STATS = ['count', 'unique', 'variety', 'countLower', 'countUpper', 'countValid', 'countTotal']
+
+    def __init__(self, stats, features, capacity=1024):
+        if isinstance(stats, str):
+            stats = stats.split()
+        if all(stat in OUTLIER_STATS for stat in stats):
+            stats = [stat for stat in OUTLIER_STATS if stat in stats]
+        else:
+            stats = zonalStatsOrder(stats)
+        self.statsColumns = ['{}_{}'.format(stat, feature) for feature in features for stat in stats]
+        self.columns = self.META_COLUMNS + self.statsColumns
+        self.dtypes = dict()
+        for column in self.META_COLUMNS:
+            self.dtypes[column] = 'datetime64[ns]' if column == 'date' else object
+        for feature in features:
+            for stat in stats:
+                if stat in self.TEXT_STATS:
+                    dtype = object
+                elif stat in self.INTEGER_STATS:
+                    dtype = np.int64
+                else:
+                    dtype = np.float64
+                self.dtypes['{}_{}'.format(stat, feature)] = dtype
+        self.size = 0
+        self.data = {column: self.emptyColumn(column, capacity) for column in self.columns}
+        # Rows with a value in the integer columns (the missing ones are exported as null)
+        self.filled = {column: np.zeros(capacity, dtype=bool) for column in self.columns if self.dtypes[column] == np.int64}
+
+    def emptyColumn(self, column, n):
+        if self.dtypes[column] == np.float64:
+            return np.full(n, np.nan)
+        if self.dtypes[column] == np.int64:
+            return np.zeros(n, dtype=np.int64)
+        if self.dtypes[column] == object:
+            return np.full(n, None, dtype=object)
+        return np.full(n, np.datetime64('NaT'), dtype=self.dtypes[column])
+
+    def __len__(self):
+        return self.size
+
+    def grow(self):
+        capacity = 2 * len(self.data['name'])
+        for column in self.columns:
+            extended = self.emptyColumn(column, capacity)
+            extended[:self.size] = self.data[column][:self.size]
+            self.data[column] = extended
+        for column in self.filled:
+            extended = np.zeros(capacity, dtype=bool)
+            extended[:self.size] = self.filled[column][:self.size]
+            self.filled[column] = extended
+
+    def appendRow(self, row):
+        # Append a dictionary with the meta columns and the {stat}_{feature} values
+        unknown = set(row) - set(self.columns)
+        if unknown:
+            raise KeyError(f'Columns not in the schema of the accumulator: {sorted(unknown)}')
+        if self.size == len(self.data['name']):
+            self.grow()
+        for column, value in row.items():
+            if value is None:
+                continue
+            if column == 'date':
+                value = np.datetime64(value, 'ns')
+            self.data[column][self.size] = value
+            if column in self.filled:
+                self.filled[column][self.size] = True
+        self.size += 1
+
+    def append(self, src, outliers=False):
+        # Append the statistics of a wqp product (outlier rejection statistics if outliers)
+        row = wqp.organizeWQPEstimates(src.outliers_stats if outliers else src.stats)
+        for column in self.META_COLUMNS:
+            row[column] = getattr(src, column, None)
+        self.appendRow(row)
+
+    def column(self, column):
+        values = self.data[column][:self.size]
+        if column in self.filled and not self.filled[column][:self.size].all():
+            # Integer column with missing values (e.g. features without statistics)
+            return pd.Series(values, dtype='Int64').mask(~self.filled[column][:self.size])
+        return values
+
+    def toDataFrame(self):
+        return pd.DataFrame({column: self.column(column) for column in self.columns}, columns=self.columns)
+
+    def toArrow(self):
+        import pyarrow as pa
+        return pa.Table.from_pandas(self.toDataFrame(), preserve_index=False)
+
+    def toParquet(self, out_path):
+        import pyarrow.parquet as pq
+        pq.write_table(self.toArrow(), out_path)
+
 # Function to normalize the grid values
 def normalize(array):
     """Normalizes numpy arrays into scale 0.0 - 1.0"""
@@ -0,0 +1,280 @@
+import os
+import re
+import pickle
+import hashlib
+import xml.etree.ElementTree as ET
+import pandas as pd
+
+"""
+REGISTRY OF THE GML GEOMETRIES
+"""
+# Raw content of the geometry properties (e.g. <ogr:geometryProperty>...</ogr:geometryProperty>)
+GEOMETRY_PROPERTY_REGEX = re.compile(r'<((?:[\w.-]+:)?geometryProperty)\b[^>]*>(.*?)</\1>', re.DOTALL)
+GEOMETRY_PROPERTY_START = re.compile(r'<(?:[\w.-]+:)?geometryProperty\b')
+# Characters read at a time when scanning the raw fragments
+READ_SIZE = 1 << 20
+# Folder of the compiled indexes (one file per folder of GML files, outside the data folders)
+REGISTRY_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'wqp', 'gml')
+REGISTRY_VERSION = 1
+
+# Tag without namespace
+def localName(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def gmlCoordinates(elem, dimension=2):
+    # Coordinates of the first posList, pos or coordinates element of a GML element
+    for child in elem.iter():
+        tag = localName(child.tag)
+        if tag in ('posList', 'pos'):
+            values = [float(v) for v in child.text.split()]
+            dimension = int(child.attrib.get('srsDimension', dimension))
+            return [tuple(values[i:i+dimension]) for i in range(0, len(values), dimension)]
+        if tag == 'coordinates':
+            cs = child.attrib.get('cs', ',')
+            ts = child.attrib.get('ts', ' ')
+            return [tuple(float(v) for v in point.split(cs)) for point in child.text.strip().split(ts) if point]
+    raise ValueError(f'No coordinates in {localName(elem.tag)}')
+
+def gmlGeometry(elem):
+    """
+    Shapely geometry of a GML 2/3 geometry element (Point, LineString, Polygon and
+    their Multi* collections, as written by OGR). The coordinates are kept in the
+    order of the file (see srsName for the axis order).
+    """
+    from shapely.geometry import Point, LineString, Polygon, MultiPoint, MultiLineString, MultiPolygon, GeometryCollection
+    tag = localName(elem.tag)
+    if tag == 'Point':
+        return Point(gmlCoordinates(elem)[0])
+    if tag in ('LineString', 'LinearRing', 'Curve'):
+        return LineString(gmlCoordinates(elem))
+    if tag in ('Polygon', 'Surface'):
+        exterior = None
+        interiors = []
+        for child in elem.iter():
+            childTag = localName(child.tag)
+            if childTag in ('exterior', 'outerBoundaryIs') and exterior is None:
+                exterior = gmlCoordinates(child)
+            elif childTag in ('interior', 'innerBoundaryIs'):
+                interiors.append(gmlCoordinates(child))
+        if exterior is None:
+            raise ValueError(f'{tag} without exterior ring')
+        return Polygon(exterior, interiors)
+    if tag.startswith('Multi'):
+        members = []
+        for child in elem:
+            if localName(child.tag).endswith(('Member', 'Members')):
+                members.extend(gmlGeometry(member) for member in child)
+        if tag in ('MultiPoint',):
+            return MultiPoint(members)
+        if tag in ('MultiLineString', 'MultiCurve'):
+            return MultiLineString(members)
+        if tag in ('MultiPolygon', 'MultiSurface'):
+            polygons = []
+            for member in members:
+                polygons.extend(member.geoms if member.geom_type == 'MultiPolygon' else [member])
+            return MultiPolygon(polygons)
+        return GeometryCollection(members)
+    raise ValueError(f'Unsupported GML geometry: {tag}')
+
+def geometryFragments(path, size=READ_SIZE):
+    """
+    Raw GML of the geometry properties of a file (as in getGMLfeature), scanned
+    chunk by chunk: only the text of the geometry being read is held in memory.
+    """
+    buffer = ''
+    with open(path, encoding='utf-8') as f:
+        for chunk in iter(lambda: f.read(size), ''):
+            buffer += chunk
+            end = 0
+            for match in GEOMETRY_PROPERTY_REGEX.finditer(buffer):
+                yield match.group(2)
+                end = match.end()
+            buffer = buffer[end:]
+            # Keep the text from the next (incomplete) geometry property or tag
+            start = GEOMETRY_PROPERTY_START.search(buffer)
+            if start is not None:
+                buffer = buffer[start.start():]
+            else:
+                buffer = buffer[buffer.rfind('<'):] if '<' in buffer else ''
+
+def readGMLFeatures(path):
+    """
+    Features of a GML file (e.g. the procedures of istSOS, one file each) read
+    with a streaming parser (iterparse, each feature is cleared once read): raw
+    GML fragment of the geometry property (as in getGMLfeature), geometry (WKB),
+    srsName, attribute fields and validity.
+    """
+    from shapely.validation import explain_validity
+    fragments = geometryFragments(path)
+    features = []
+    feature = None
+    depth = 0
+    geometryDepth = None
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        tag = localName(elem.tag)
+        if event == 'start':
+            depth += 1
+            if tag in ('featureMember', 'member') and feature is None:
+                feature = {'fields': dict(), 'fragment': None, 'geometry': None, 'srsName': None, 'error': None, 'depth': depth}
+            elif tag == 'geometryProperty' and feature is not None:
+                geometryDepth = depth
+            continue
+        if feature is not None and tag == 'geometryProperty':
+            feature['fragment'] = next(fragments, None)
+            geometry = elem[0] if len(elem) else None
+            if geometry is not None:
+                feature['srsName'] = geometry.attrib.get('srsName')
+                try:
+                    feature['geometry'] = gmlGeometry(geometry)
+                except (ValueError, TypeError, AttributeError) as e:
+                    feature['error'] = f'{type(e).__name__}: {e}'
+            geometryDepth = None
+            elem.clear()
+        elif feature is not None and geometryDepth is None and depth == feature['depth'] + 2 and len(elem) == 0:
+            # Attribute fields of the feature (children of the feature element)
+            feature['fields'][tag] = elem.text
+        elif feature is not None and depth == feature['depth']:
+            features.append(feature)
+            feature = None
+            elem.clear()
+        depth -= 1
+    entries = []
+    for feature in features:
+        geometry = feature['geometry']
+        if geometry is None:
+            valid, reason = False, feature['error'] or 'Missing geometry'
+        elif geometry.is_empty:
+            valid, reason = False, 'Empty geometry'
+        else:
+            valid = geometry.is_valid
+            reason = None if valid else explain_validity(geometry)
+        entries.append({
+            'fragment': feature['fragment'],
+            'wkb': geometry.wkb if geometry is not None else None,
+            'srsName': feature['srsName'],
+            'fields': feature['fields'],
+            'valid': valid,
+            'reason': reason,
+        })
+    return entries
+
+class gmlRegistry:
+    """
+    GML features of all the files of a folder (e.g. procedures_istSOS), parsed once
+    and kept in memory by file name (procedure). The parsed features are stored in
+    a compiled index in cacheDir (not in the data folder): a file is parsed again
+    only when its modification time or size changes.
+        vector_path: folder of the GML files
+        cacheDir: folder of the compiled index (None: the index is not saved)
+    """
+    def __init__(self, vector_path, cacheDir=REGISTRY_CACHE_DIR):
+        self.vector_path = vector_path
+        self.index_path = None
+        if cacheDir is not None:
+            key = hashlib.sha1(os.path.abspath(vector_path).encode('utf-8')).hexdigest()[:16]
+            self.index_path = os.path.join(cacheDir, f'{key}.pkl')
+        self.entries = dict()
+        self.geometries = dict()
+        if self.index_path is not None and os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'rb') as f:
+                    index = pickle.load(f)
+                if index.get('version') == REGISTRY_VERSION:
+                    self.entries = index['entries']
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError, KeyError):
+                self.entries = dict()
+        self.refresh()
+
+    def filePath(self, procedure):
+        return os.path.join(self.vector_path, f'{procedure}.gml')
+
+    def update(self, procedure):
+        # Parse the file of a procedure if it is not in the index or it changed. Returns True if parsed
+        st = os.stat(self.filePath(procedure))
+        entry = self.entries.get(procedure)
+        if entry is not None and entry['mtime'] == st.st_mtime and entry['size'] == st.st_size:
+            return False
+        try:
+            features, error = readGMLFeatures(self.filePath(procedure)), None
+        except (ET.ParseError, UnicodeDecodeError) as e:
+            # Reported by features() and toDataFrame, the other files are still registered
+            features, error = [], f'{type(e).__name__}: {e}'
+        self.entries[procedure] = {'mtime': st.st_mtime, 'size': st.st_size, 'features': features, 'error': error}
+        self.geometries.pop(procedure, None)
+        return True
+
+    def refresh(self):
+        """
+        Synchronize the registry with the folder: new and modified files are parsed,
+        removed files are dropped and the index is saved if anything changed.
+        """
+        procedures = [f[:-4] for f in os.listdir(self.vector_path) if f.endswith('.gml')]
+        changed = [procedure for procedure in procedures if self.update(procedure)]
+        removed = [procedure for procedure in self.entries if procedure not in procedures]
+        for procedure in removed:
+            del self.entries[procedure]
+            self.geometries.pop(procedure, None)
+        if changed or removed:
+            self.save()
+        return {'updated': len(changed), 'removed': len(removed)}
+
+    def save(self):
+        if self.index_path is None:
+            return
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': REGISTRY_VERSION, 'entries': self.entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+
+    def features(self, procedure):
+        if self.update(procedure):
+            self.save()
+        if self.entries[procedure]['error'] is not None:
+            raise ValueError(f"{self.filePath(procedure)}: {self.entries[procedure]['error']}")
+        return self.entries[procedure]['features']
+
+    def fragment(self, procedure, index=0):
+        # Raw GML of the geometry of a procedure (first feature by default)
+        return self.features(procedure)[index]['fragment']
+
+    def geometry(self, procedure, index=0):
+        # Shapely geometry of a procedure, built once from the index
+        from shapely import wkb
+        features = self.features(procedure)
+        if procedure not in self.geometries:
+            self.geometries[procedure] = [wkb.loads(f['wkb']) if f['wkb'] is not None else None for f in features]
+        return self.geometries[procedure][index]
+
+    def toDataFrame(self):
+        # Features of all the procedures with their validity
+        rows = []
+        for procedure, entry in sorted(self.entries.items()):
+            if entry['error'] is not None:
+                rows.append({'procedure': procedure, 'feature': None, 'srsName': None, 'valid': False, 'reason': entry['error']})
+            for i, feature in enumerate(entry['features']):
+                rows.append({'procedure': procedure, 'feature': i, 'srsName': feature['srsName'],
+                             'valid': feature['valid'], 'reason': feature['reason'], **feature['fields']})
+        return pd.DataFrame(rows)
+
+    def invalid(self):
+        df = self.toDataFrame()
+        return df.loc[~df['valid']] if len(df) else df
+
+    def toGeoDataFrame(self, procedures=None, nameField='procedure', crs=None):
+        """
+        GeoDataFrame with the first feature of each procedure (e.g. the basins used by
+        computeStatistics with nameField), sharing the geometries of the registry.
+        """
+        import geopandas as gpd
+        procedures = procedures or sorted(self.entries)
+        return gpd.GeoDataFrame({nameField: procedures}, geometry=[self.geometry(p) for p in procedures], crs=crs)
+
+# Registries of the folders read by getGMLfeature
+GML_REGISTRIES = dict()
+
+def getRegistry(vector_path, cacheDir=REGISTRY_CACHE_DIR):
+    key = os.path.abspath(vector_path)
+    if key not in GML_REGISTRIES:
+        GML_REGISTRIES[key] = gmlRegistry(vector_path, cacheDir)
+    return GML_REGISTRIES[key]
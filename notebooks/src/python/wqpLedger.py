@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+import sqlite3
+from datetime import datetime
+import pandas as pd
+
+"""
+PRODUCTION LEDGER
+"""
+# Parameters that depend on the product extent: replaced by the ROI bounding box in the hash
+SCENE_EXTENT_PARAMETERS = ('geoRegion', 'region')
+
+def paramsHash(parameters):
+    # Hash of the processing parameters (independent of the keys order)
+    text = json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def upstreamNodes(graph_nodes, outputs):
+    # Node ids of graph_nodes needed to compute the outputs (node ids)
+    sources = {nodeId: source for nodeId, paramsName, source in graph_nodes}
+    used = set()
+    pending = [nodeId for nodeId in outputs if nodeId in sources]
+    while pending:
+        nodeId = pending.pop()
+        if nodeId not in used:
+            used.add(nodeId)
+            if sources[nodeId] in sources:
+                pending.append(sources[nodeId])
+    return used
+
+def sceneParameters(wqpParams, params, bbox, writeFormat, outputs=None):
+    """
+    Processing parameters that define the outputs of a scene: the parameters of
+    every node of wqpParams.graph_nodes (with the scene values in params, e.g. the
+    C2RCC temperature or the BandMaths expressions), the ROI bounding box and the
+    output format. With outputs (node ids), only the nodes needed by the outputs.
+    """
+    used = upstreamNodes(wqpParams.graph_nodes, outputs) if outputs is not None else None
+    nodes = dict()
+    for nodeId, paramsName, source in wqpParams.graph_nodes:
+        if used is not None and nodeId not in used:
+            continue
+        parameters = params.get(paramsName, getattr(wqpParams, paramsName))
+        nodes[nodeId] = {
+            'operator': parameters[0]['operator'],
+            'source': source,
+            'parameters': {key: value for key, value in parameters[1].items() if key not in SCENE_EXTENT_PARAMETERS},
+        }
+    return {'nodes': nodes, 'bbox': bbox, 'writeFormat': writeFormat}
+
+class productionLedger:
+    """
+    Persistent record (SQLite) of the SNAP products already processed. Each scene
+    is stored by product name (snapProduct.name) with the hash of its processing
+    parameters and the list of the written outputs. A scene is current when its
+    last run succeeded with the same parameters hash and all its outputs exist,
+    or it was skipped (outside the ROI) with the same parameters hash; any change
+    of the parameters (e.g. C2RCC temperature, BandMaths expressions) makes it
+    pending again.
+        db_path: path to the SQLite file storing the ledger
+    """
+    COLUMNS = ['name', 'sensor', 'path', 'params_hash', 'outputs', 'status', 'updated', 'error']
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, timeout=60)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS scenes (
+                name TEXT PRIMARY KEY,
+                sensor TEXT,
+                path TEXT,
+                params_hash TEXT,
+                outputs TEXT,
+                status TEXT,
+                updated TEXT,
+                error TEXT
+            )''')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, name, sensor, path, paramsHash, outputs, status='done', error=None):
+        # Result of the last run of a scene (a failed run keeps the outputs of the previous one)
+        with self.connection:
+            if status == 'failed':
+                row = self.connection.execute('SELECT outputs FROM scenes WHERE name = ?', (name,)).fetchone()
+                outputs = json.loads(row[0]) if row is not None and row[0] is not None else outputs
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO scenes ({','.join(self.COLUMNS)}) VALUES ({','.join('?'*len(self.COLUMNS))})",
+                (name, sensor, path, paramsHash, json.dumps(outputs) if outputs is not None else None,
+                 status, datetime.now().isoformat(timespec='seconds'), error))
+
+    def entry(self, name):
+        row = self.connection.execute(f"SELECT {','.join(self.COLUMNS)} FROM scenes WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(zip(self.COLUMNS, row))
+        entry['outputs'] = json.loads(entry['outputs']) if entry['outputs'] is not None else []
+        return entry
+
+    def isCurrent(self, name, paramsHash):
+        # Processed (or skipped) with the same parameters and all the outputs are still on disk
+        entry = self.entry(name)
+        if entry is None or entry['params_hash'] != paramsHash:
+            return False
+        if entry['status'] == 'skipped':
+            return True
+        if entry['status'] != 'done':
+            return False
+        return len(entry['outputs']) > 0 and all(os.path.exists(out_file) for out_file in entry['outputs'])
+
+    def toDataFrame(self, status=None):
+        sql = 'SELECT * FROM scenes'
+        params = []
+        if status is not None:
+            sql += ' WHERE status = ?'
+            params.append(status)
+        df = pd.read_sql_query(sql + ' ORDER BY name', self.connection, params=params)
+        df['updated'] = pd.to_datetime(df['updated'])
+        return df
@@ -0,0 +1,122 @@
+import os
+import xml.etree.ElementTree as ET
+import pandas as pd
+
+"""
+SCENE PRE-SCREENING FROM THE PRODUCT METADATA
+"""
+# MTL.txt corners (lat, lon keys) in ring order
+MTL_CORNERS = ['UL', 'UR', 'LR', 'LL']
+
+# Tag without namespace
+def localName(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def readS3Manifest(path):
+    """
+    Metadata of a S3 product from its xfdumanifest.xml, read with a streaming
+    parser (no SNAP): footprint (gml:posList), acquisition start time and the
+    percentages of the classification summary (e.g. salineWaterPixels,
+    brightPixels, cloudyPixels, landPixels depending on the product level).
+    """
+    info = {'path': path, 'name': path.replace(os.sep, '/').split('/')[-2].split('.')[0], 'sensor': 'S3',
+            'time': None, 'footprint': None, 'percentages': dict()}
+    for event, elem in ET.iterparse(path, events=('end',)):
+        tag = localName(elem.tag)
+        if tag == 'posList' and info['footprint'] is None:
+            values = [float(v) for v in elem.text.split()]
+            info['footprint'] = list(zip(values[1::2], values[0::2]))
+        elif tag == 'startTime' and info['time'] is None:
+            time = pd.Timestamp(elem.text)
+            info['time'] = time.tz_convert(None) if time.tzinfo is not None else time
+        elif 'percentage' in elem.attrib:
+            info['percentages'][tag] = float(elem.attrib['percentage'])
+        elem.clear()
+    return info
+
+def readL8MTL(path):
+    """
+    Metadata of a L8 product from its MTL.txt, read line by line (no SNAP):
+    footprint (product corners), acquisition time and cloud cover.
+    """
+    values = dict()
+    with open(path) as f:
+        for line in f:
+            if '=' not in line:
+                continue
+            key, value = [v.strip() for v in line.split('=', 1)]
+            values[key] = value.strip('"')
+    info = {'path': path, 'name': path.replace(os.sep, '/').split('/')[-2].split('.')[0], 'sensor': 'L8',
+            'time': None, 'footprint': None, 'percentages': dict()}
+    if 'DATE_ACQUIRED' in values:
+        info['time'] = pd.Timestamp(f"{values['DATE_ACQUIRED']} {values.get('SCENE_CENTER_TIME', '00:00:00').rstrip('Z')[:15]}")
+    corners = [(f'CORNER_{c}_LON_PRODUCT', f'CORNER_{c}_LAT_PRODUCT') for c in MTL_CORNERS]
+    if all(lon in values and lat in values for lon, lat in corners):
+        info['footprint'] = [(float(values[lon]), float(values[lat])) for lon, lat in corners]
+    for key, name in [('CLOUD_COVER', 'cloudyPixels'), ('CLOUD_COVER_LAND', 'cloudyLandPixels')]:
+        if key in values and float(values[key]) >= 0:
+            info['percentages'][name] = float(values[key])
+    return info
+
+def readSceneInfo(path):
+    # Metadata of a S3 (xfdumanifest.xml) or L8 (MTL.txt) product
+    if path.endswith('MTL.txt'):
+        return readL8MTL(path)
+    return readS3Manifest(path)
+
+def cloudPercentage(percentages):
+    # Cloud cover of the scene: cloudyPixels when available, otherwise the bright pixels of the L1 products
+    for key in ('cloudyPixels', 'brightPixels'):
+        if key in percentages:
+            return percentages[key]
+    return None
+
+def screenScenes(paths, bbox, maxCloud=None, minOverlap=0.0):
+    """
+    Pre-screening of a list of products before ProductIO.readProduct: only the
+    manifest (S3) or MTL.txt (L8) is read. Each scene is ranked by the fraction of
+    the ROI bounding box covered by its footprint (overlap) and by its cloud cover.
+        paths: products (xfdumanifest.xml or MTL.txt)
+        bbox: ROI bounding box (as in snapProduct)
+        maxCloud: maximum cloud percentage (None: no limit)
+        minOverlap: minimum fraction of the ROI covered by the footprint
+    Returns a dataframe (best scenes first) with the column keep; the scenes with
+    keep=False do not need to be read by SNAP, e.g.
+        df = screenScenes(paths, bbox, maxCloud=80, minOverlap=0.1)
+        paths = df.loc[df['keep'], 'path'].tolist()
+    """
+    from shapely.geometry import Polygon, box
+    roi = box(bbox['minLon'], bbox['minLat'], bbox['maxLon'], bbox['maxLat'])
+    rows = []
+    for path in paths:
+        try:
+            info = readSceneInfo(path)
+            error = None
+        except (OSError, ET.ParseError, ValueError) as e:
+            info = {'path': path, 'name': None, 'sensor': None, 'time': None, 'footprint': None, 'percentages': dict()}
+            error = f'{type(e).__name__}: {e}'
+        overlap = None
+        if info['footprint'] is not None and len(info['footprint']) >= 3:
+            footprint = Polygon(info['footprint'])
+            if not footprint.is_valid:
+                footprint = footprint.buffer(0)
+            overlap = footprint.intersection(roi).area / roi.area
+        row = {
+            'path': path,
+            'name': info['name'],
+            'sensor': info['sensor'],
+            'time': info['time'],
+            'overlap': overlap,
+            'cloud': cloudPercentage(info['percentages']),
+            'error': error,
+        }
+        row.update(info['percentages'])
+        rows.append(row)
+    columns = ['path', 'name', 'sensor', 'time', 'overlap', 'cloud', 'error']
+    df = pd.DataFrame(rows, columns=columns + sorted({k for row in rows for k in row} - set(columns)))
+    # Scenes without metadata are kept: they are screened by SNAP
+    keep = df['overlap'].isna() | ((df['overlap'] > 0) & (df['overlap'] >= minOverlap))
+    if maxCloud is not None:
+        keep &= df['cloud'].isna() | (df['cloud'] <= maxCloud)
+    df['keep'] = keep
+    return df.sort_values(['keep', 'overlap', 'cloud'], ascending=[False, False, True], na_position='last').reset_index(drop=True)
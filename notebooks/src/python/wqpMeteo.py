@@ -0,0 +1,180 @@
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+
+"""
+METEO PARAMETERS FOR THE SNAP PROCESSING
+"""
+# Format of the timestamps in meteoTemp.csv
+METEO_TIME_FORMAT = '%d-%m-%Y %H:%M'
+LOOKUP_METHODS = ('floor', 'nearest', 'linear')
+
+# Acquisition time of a S3 product from its name (e.g. S3A_OL_1_EFR____20190315T094218_...)
+def sceneTime(name):
+    return pd.Timestamp(pd.to_datetime(name.split('_')[7], format='%Y%m%dT%H%M%S'))
+
+class meteoLookup:
+    """
+    Time indexed lookup of a meteo series (e.g. the air temperature of meteoTemp.csv
+    used as C2RCC temperature). The samples are kept as sorted arrays so each
+    lookup is a binary search (searchsorted):
+        floor: last sample at or before the time (the 10 minutes slot of extractTemp)
+        nearest: closest sample
+        linear: linear interpolation between the samples before and after the time
+    A time without samples closer than maxGap gives NaN (lookupMany) or raises a
+    ValueError (lookup).
+        times: sample times (datetime64 or values parsed by pd.to_datetime)
+        values: sample values
+    """
+    def __init__(self, times, values, maxGap='10min', method='floor'):
+        times = np.asarray(pd.to_datetime(times).values, dtype='datetime64[ns]').astype(np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        order = np.argsort(times[valid], kind='mergesort')
+        self.times = times[valid][order]
+        self.values = values[valid][order]
+        self.maxGap = pd.Timedelta(maxGap)
+        self.method = method
+
+    @classmethod
+    def fromDataFrame(cls, df, timeColumn='Data', valueColumn='Valore', timeFormat=METEO_TIME_FORMAT, **kwargs):
+        times = df[timeColumn]
+        if not pd.api.types.is_datetime64_any_dtype(times):
+            times = pd.to_datetime(times, format=timeFormat)
+        return cls(times, df[valueColumn], **kwargs)
+
+    @classmethod
+    def fromCSV(cls, csv_path, timeColumn='Data', valueColumn='Valore', timeFormat=METEO_TIME_FORMAT, cache=True, **kwargs):
+        """
+        Lookup of a meteo CSV (e.g. meteoTemp.csv). With cache, the parsed series is
+        saved next to the CSV (.npz) and read instead of the CSV while the CSV
+        modification time and size do not change.
+        """
+        st = os.stat(csv_path)
+        cache_path = os.path.splitext(csv_path)[0] + f'_{valueColumn}.npz'
+        if cache and os.path.exists(cache_path):
+            try:
+                with np.load(cache_path) as data:
+                    if data['mtime'] == st.st_mtime and data['size'] == st.st_size:
+                        return cls(data['times'].astype('datetime64[ns]'), data['values'], **kwargs)
+            except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+                # Corrupt cache: read the CSV again
+                pass
+        df = pd.read_csv(csv_path, usecols=[timeColumn, valueColumn])
+        lookup = cls.fromDataFrame(df, timeColumn, valueColumn, timeFormat, **kwargs)
+        if cache:
+            # The cache is shared by the scheduler workers: written to a file of the process and then replaced
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, times=lookup.times, values=lookup.values, mtime=st.st_mtime, size=st.st_size)
+            os.replace(tmp_path, cache_path)
+        return lookup
+
+    def __len__(self):
+        return len(self.times)
+
+    def lookupMany(self, times, method=None, maxGap=None):
+        # Values at several times in a single vectorized pass (NaN when there are no samples within maxGap)
+        method = method or self.method
+        if method not in LOOKUP_METHODS:
+            raise ValueError(f'Unknown lookup method: {method}. Use one of {LOOKUP_METHODS}')
+        gap = (pd.Timedelta(maxGap) if maxGap is not None else self.maxGap).value
+        t = np.asarray(pd.to_datetime(times).values, dtype='datetime64[ns]').astype(np.int64)
+        out = np.full(t.shape, np.nan)
+        n = len(self.times)
+        if n == 0:
+            return out
+        # Samples before (lo) and after (hi) each time: times[lo] <= t < times[hi]
+        hi = np.searchsorted(self.times, t, side='right')
+        lo = hi - 1
+        hasLo = lo >= 0
+        hasHi = hi < n
+        lo = np.clip(lo, 0, n - 1)
+        hi = np.clip(hi, 0, n - 1)
+        dLo = np.where(hasLo, t - self.times[lo], np.iinfo(np.int64).max)
+        dHi = np.where(hasHi, self.times[hi] - t, np.iinfo(np.int64).max)
+        if method == 'floor':
+            ok = hasLo & (dLo <= gap)
+            out[ok] = self.values[lo[ok]]
+        elif method == 'nearest':
+            useLo = dLo <= dHi
+            idx = np.where(useLo, lo, hi)
+            ok = np.where(useLo, dLo, dHi) <= gap
+            out[ok] = self.values[idx[ok]]
+        else:
+            exact = hasLo & (dLo == 0)
+            out[exact] = self.values[lo[exact]]
+            ok = ~exact & hasLo & hasHi & (dLo <= gap) & (dHi <= gap)
+            w = dLo[ok] / (self.times[hi[ok]] - self.times[lo[ok]])
+            out[ok] = self.values[lo[ok]] + w * (self.values[hi[ok]] - self.values[lo[ok]])
+        return out
+
+    def lookup(self, time, method=None, maxGap=None):
+        value = self.lookupMany([time], method, maxGap)[0]
+        if np.isnan(value):
+            raise ValueError(f'No meteo values within {maxGap or self.maxGap} of {pd.Timestamp(time)}')
+        return float(value)
+
+    def sceneValues(self, names, method=None, maxGap=None):
+        # Values for a list of S3 products (name, time, value), e.g. all the scenes of a batch
+        times = [sceneTime(name) for name in names]
+        return pd.DataFrame({'name': list(names), 'time': times, 'value': self.lookupMany(times, method, maxGap)})
+
+"""
+ATMOSPHERIC CORRECTION OF THE L8 LSWT
+"""
+# Format of the timestamps in atmCorr.csv
+ATM_CORR_TIME_FORMAT = '%Y/%m/%d %H:%M'
+
+# LSWT from the TIRS band 10 with the atmospheric correction parameters Lu, t, Ld
+LSWT_EXPRESSION = "(1321.08 / log(774.89/ ((('thermal_infrared_(tirs)_1')-{Lu}-{t} *(1-0.98)*{Ld})/({t} *0.98))+1)-273)"
+# BandMaths expressions of the L8 target bands
+ATM_CORR_EXPRESSIONS = {
+    'lswt_mid_high': "if simile_laghi and not (cloud or cloud_confidence_mid or cloud_shadow_confidence_mid or cloud_shadow_confidence_high or cirrus_confidence_mid or cirrus_confidence_high) then {lswt} else NaN",
+    'lswt_high': "if simile_laghi and not (cloud or cloud_shadow_confidence_high or cirrus_confidence_high) then {lswt} else NaN",
+    'lswt': "{lswt}",
+}
+
+# Acquisition date of a L8 product from its name (e.g. LC08_L1TP_194028_20190315_...)
+def l8SceneDate(name):
+    return pd.Timestamp(pd.to_datetime(name.split('_')[3], format='%Y%m%d'))
+
+def atmCorrExpressions(Lu, t, Ld):
+    lswt = LSWT_EXPRESSION.format(Lu=Lu, t=t, Ld=Ld)
+    return {band: expression.format(lswt=lswt) for band, expression in ATM_CORR_EXPRESSIONS.items()}
+
+def resolveAtmCorr(names, df_atm):
+    """
+    Atmospheric correction parameters (Lu, t, Ld) and BandMaths expressions of a
+    list of L8 products, joined with atmCorr.csv in a single merge. The products
+    without parameters for their date have missing=True, so they can be reported
+    before any SNAP processing.
+        names: L8 product names
+        df_atm: atmCorr.csv dataframe (DateTime, Lu, t, Ld)
+    Returns a dataframe indexed by name with the columns date, Lu, t, Ld, missing
+    and one column for each expression of ATM_CORR_EXPRESSIONS.
+    """
+    scenes = pd.DataFrame({'name': list(names)})
+    scenes['date'] = [l8SceneDate(name) for name in scenes['name']]
+    dates = df_atm['DateTime']
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        # Timestamps of atmCorr.csv or dates (as in the notebook)
+        dates = pd.to_datetime(dates.astype(str))
+    # The first parameters of each day (as extractAtmCorr)
+    atm = pd.DataFrame({'date': dates.dt.normalize().values, 'row': np.arange(len(df_atm))})
+    atm = atm.drop_duplicates('date', keep='first')
+    df = scenes.merge(atm, on='date', how='left').set_index('name')
+    found = df['row'].notna().values
+    values = df_atm[['Lu', 't', 'Ld']].iloc[df['row'].values[found].astype(int)]
+    for column in ['Lu', 't', 'Ld']:
+        df[column] = np.nan
+        df.loc[found, column] = values[column].values
+    df['missing'] = df[['Lu', 't', 'Ld']].isna().any(axis=1)
+    # Expressions formatted with the values as read from atmCorr.csv
+    expressions = [atmCorrExpressions(Lu, t, Ld) for Lu, t, Ld in values.itertuples(index=False)]
+    for band in ATM_CORR_EXPRESSIONS:
+        df[band] = None
+        df.loc[found, band] = [e[band] for e in expressions]
+        df.loc[df['missing'].values, band] = None
+    return df.drop(columns='row')
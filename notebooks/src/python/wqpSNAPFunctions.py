@@ -1,10 +1,16 @@
 """
 1. IMPORTS
 """
-import math
+import copy
+import importlib
+import json
 import os
-from datetime import datetime
+import subprocess
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
 import pandas as pd
+from wqpMeteo import meteoLookup, sceneTime, resolveAtmCorr, ATM_CORR_EXPRESSIONS
+from wqpFootprint import productBounds, intersects
 import snappy
 from snappy import (ProgressMonitor, VectorDataNode,
                     WKTReader, ProductIO, PlainFeatureFactory,
@@ -25,39 +31,43 @@ class snapProduct:
         self.name = path.split('/')[-2].split('.')[0]
         self.bbox = bbox # ROI bounding box
 
-    def readSNAPProduct(self):
+    def readSNAPProduct(self, cache=None):
         # Read the product
         df = ProductIO.readProduct(self.path)
         self.product = df
-        # Get the bounding box for the product
-        minLon_p, maxLon_p, minLat_p, maxLat_p = getExtent(df)
-        self.bbox_prod = {
-            'minLat' : minLat_p,
-            'maxLat' : maxLat_p,
-            'minLon' : minLon_p,
-            'maxLon' : maxLon_p,   
-        }
+        # Get the bounding box for the product (from the footprintCache if given)
+        bbox_prod = cache.get(self.path) if cache is not None else None
+        if bbox_prod is None:
+            minLon_p, maxLon_p, minLat_p, maxLat_p = getExtent(df)
+            bbox_prod = {
+                'minLat' : minLat_p,
+                'maxLat' : maxLat_p,
+                'minLon' : minLon_p,
+                'maxLon' : maxLon_p,   
+            }
+            if cache is not None:
+                cache.put(self.path, bbox_prod)
+                cache.save()
+        self.bbox_prod = bbox_prod
+        # Products outside the ROI can be skipped before any band is read
+        self.intersects = intersects(self.bbox, self.bbox_prod)
         # Bounding box for the estimation of the wqp maps
         self.bbox_trim = trimBbox(self.bbox,self.bbox_prod)
     
-    def updateSNAPSubset(self, params_subset):
+    def subsetRegion(self):
         bbox_trim = self.bbox_trim
-        bbox_ex = f"POLYGON(({bbox_trim['minLon']} {bbox_trim['maxLat']},{bbox_trim['minLon']} {bbox_trim['minLat']},{bbox_trim['maxLon']} {bbox_trim['minLat']},{bbox_trim['minLon']} {bbox_trim['maxLat']}))"
-        params_subset[1]['geoRegion'] = bbox_ex
-        return params_subset
+        return f"POLYGON(({bbox_trim['minLon']} {bbox_trim['maxLat']},{bbox_trim['minLon']} {bbox_trim['minLat']},{bbox_trim['maxLon']} {bbox_trim['minLat']},{bbox_trim['minLon']} {bbox_trim['maxLat']}))"
+
+    # The update methods return updated copies: the parameters of wqpSNAPparams_* are not modified
+    def updateSNAPSubset(self, params_subset):
+        return [params_subset[0], dict(params_subset[1], geoRegion=self.subsetRegion())]
 
     def updateSNAPTemperature(self, df_temp, params_C2RCC):
-        #TODO: update temperature parameters_C2RCC
-        params_C2RCC[1]['temperature']= extractTemp(self.name, df_temp)
-        return params_C2RCC
+        return [params_C2RCC[0], dict(params_C2RCC[1], temperature=extractTemp(self.name, df_temp))]
     
     def updateSNAPAtmCorr(self, df_atm, params_bandMaths):
-        #TODO: update temperature parameters_C2RCC
         bExpresions = extractAtmCorr(self.name, df_atm)
-        params_bandMaths[1]['targetBands'][0]['expression'] = bExpresions['lswt_mid_high']
-        params_bandMaths[1]['targetBands'][1]['expression'] = bExpresions['lswt_high']
-        params_bandMaths[1]['targetBands'][2]['expression'] = bExpresions['lswt']
-        return params_bandMaths
+        return [params_bandMaths[0], updateTargetBands(params_bandMaths[1], bExpresions)]
     
 
 """
@@ -78,6 +88,8 @@ def inputParameters(sensor_input, sensor_output):
             'out_wqp_no_clip':os.path.join(sensor_output,'wqp_no_clip'),
             'out_wqp_cloud':os.path.join(sensor_output,'wqp_cloud_mask'),
             'out_wqp_no_mask':os.path.join(sensor_output,'wqp_no_mask'),
+            'out_sources':os.path.join(sensor_output,'sources'),
+            'out_cube':os.path.join(sensor_output,'cube'),
             'in_parameters': f'./in/satellite_imagery/wqp_parameters',
             'vectorFile':'./vector/simile_laghi/simile_laghi.shp',
         }
@@ -106,42 +118,86 @@ def inputParameters(sensor_input, sensor_output):
 
     return cwd_path
 
+# Copies of the processing parameters of each wqpSNAPparams_* module, taken at first use
+FROZEN_PARAMS = dict()
+
+def frozenParams(module):
+    if module not in FROZEN_PARAMS:
+        wqpParams = importlib.import_module(module)
+        FROZEN_PARAMS[module] = {key: copy.deepcopy(value) for key, value in vars(wqpParams).items() if key.startswith('params_')}
+    return FROZEN_PARAMS[module]
+
+# New BandMaths parameters with the expressions of some target bands replaced ({band name: expression})
+def updateTargetBands(parameters, expressions):
+    targetBands = [dict(tb, expression=expressions[tb['name']]) if tb['name'] in expressions else tb
+                   for tb in parameters['targetBands']]
+    return dict(parameters, targetBands=targetBands)
+
+class sceneParams:
+    """
+    Processing parameters of a scene: the values of the scene (e.g. subset region,
+    C2RCC temperature, BandMaths expressions) layered on the defaults of a
+    wqpSNAPparams_* module. Neither the module nor the object are modified: derive
+    returns a new sceneParams and the parameters are returned as deep copies, so the
+    same defaults can be shared by several scenes (and sent to worker processes).
+        wqpParams: module (or module name) with the default parameters
+    e.g.
+        params = sceneParams(wqpParams_S3).derive('params_C2RCC', temperature=12.5)
+        params['params_C2RCC']
+    """
+    def __init__(self, wqpParams, overrides=None):
+        self.module = wqpParams if isinstance(wqpParams, str) else wqpParams.__name__
+        self.overrides = overrides or dict() # {parameters name: {key: value}}
+
+    def derive(self, paramsName, **values):
+        overrides = dict(self.overrides)
+        overrides[paramsName] = dict(overrides.get(paramsName, dict()), **copy.deepcopy(values))
+        return sceneParams(self.module, overrides)
+
+    def deriveTargetBands(self, paramsName, expressions):
+        # New BandMaths expressions for the target bands in expressions ({band name: expression})
+        targetBands = updateTargetBands(self[paramsName][1], expressions)['targetBands']
+        return self.derive(paramsName, targetBands=targetBands)
+
+    def __getitem__(self, paramsName):
+        # Copy: the caller can modify the parameters without changing the defaults of the other scenes
+        defaults = frozenParams(self.module)[paramsName]
+        if paramsName not in self.overrides:
+            return copy.deepcopy(defaults)
+        return copy.deepcopy([defaults[0], dict(defaults[1], **self.overrides[paramsName])])
+
+    def __contains__(self, paramsName):
+        return paramsName in frozenParams(self.module)
+
+    def get(self, paramsName, default=None):
+        return self[paramsName] if paramsName in self else default
+
 """
 3. DEFINE FUNCTIONS TO EXECUTE SNAP OPERATORS
 """
-#Define function to extract the atmosferic correction parameters
-def extractTemp(name, df_temp):
-    #TODO: review time rounding vs interpolation
-    date = name.split('_')[7]
-    round_min = str(math.floor(int(date[11:13])/10)*10)
-    if round_min == '0':
-        dateFormat = "%s-%s-%s %s:%s" % (date[0:4],date[4:6],date[6:8],date[9:11],'00')
-    else:
-        dateFormat = "%s-%s-%s %s:%s" % (date[0:4],date[4:6],date[6:8],date[9:11],round_min)
-    values = df_temp.loc[df_temp['Data']==dateFormat]
-    t = values.iloc[0]['Valore']
+#Define function to extract the C2RCC temperature
+def extractTemp(name, df_temp, method=None, maxGap=None):
+    # df_temp: meteoLookup of meteoTemp.csv (a dataframe is indexed on every call).
+    # method/maxGap default to the ones of the lookup (floor, 10 minutes: the 10 minutes
+    # slot of the acquisition time)
+    if not isinstance(df_temp, meteoLookup):
+        df_temp = meteoLookup.fromDataFrame(df_temp)
+    date = sceneTime(name)
+    t = df_temp.lookup(date, method, maxGap)
     if t < 0:
         #Error on the processing for negative
         t = 0.1
-    print('Date: {} \nTemperature: {}°C'.format(dateFormat,t))
+    print('Date: {} \nTemperature: {}°C'.format(date,t))
     return t
 
 #Define function to extract the atmosferic correction parameters
 def extractAtmCorr(name, df_atm):
-    try:
-        refDate = datetime.strptime(name.split('_')[3], '%Y%m%d') 
-        df_check = df_atm.loc[df_atm['DateTime']==refDate.date()]
-        Lu = df_check.iloc[0].Lu
-        t = df_check.iloc[0].t
-        Ld = df_check.iloc[0].Ld
-        bExpression = dict()
-        bExpression['lswt_mid_high'] = f"if simile_laghi and not (cloud or cloud_confidence_mid or cloud_shadow_confidence_mid or cloud_shadow_confidence_high or cirrus_confidence_mid or cirrus_confidence_high) then (1321.08 / log(774.89/ ((('thermal_infrared_(tirs)_1')-{Lu}-{t} *(1-0.98)*{Ld})/({t} *0.98))+1)-273) else NaN"
-        bExpression['lswt_high'] = f"if simile_laghi and not (cloud or cloud_shadow_confidence_high or cirrus_confidence_high) then (1321.08 / log(774.89/ ((('thermal_infrared_(tirs)_1')-{Lu}-{t} *(1-0.98)*{Ld})/({t} *0.98))+1)-273) else NaN"
-        bExpression['lswt'] = f"(1321.08 / log(774.89/ ((('thermal_infrared_(tirs)_1')-{Lu}-{t} *(1-0.98)*{Ld})/({t} *0.98))+1)-273)"
-        print(f'Date: {refDate} \n Lu: {Lu}, t: {t}, Ld: {Ld}')
-    except:
-        print("There are no atmosferic correction parameters for the specified date")
-    return bExpression
+    # For a list of products use resolveAtmCorr (single merge with atmCorr.csv)
+    atm = resolveAtmCorr([name], df_atm).iloc[0]
+    if atm['missing']:
+        raise ValueError(f"There are no atmosferic correction parameters for {name} ({atm['date'].date()})")
+    print(f"Date: {atm['date']} \n Lu: {atm['Lu']}, t: {atm['t']}, Ld: {atm['Ld']}")
+    return {band: atm[band] for band in ATM_CORR_EXPRESSIONS}
 
 
 #Add processing parameters
@@ -168,53 +224,41 @@ def buildTargetBands(parameters):
 
     return parameters_bandmaths
 
-#General function to execute SNAP functions
-def executeSNAPFunction(product, parameters):
-    operator = parameters[0]['operator']
-    params = parameters[1]
+# Java parameters (HashMap and BandDescriptor array) already built, by operator and parameters
+JAVA_PARAMS_CACHE = OrderedDict()
+JAVA_PARAMS_CACHE_SIZE = 64
+
+def javaParameters(operator, params):
+    # The parameters are only read by GPF.createProduct: the same HashMap is reused
+    # by all the scenes with the same values
+    key = (operator, json.dumps(params, sort_keys=True, default=str))
+    if key in JAVA_PARAMS_CACHE:
+        JAVA_PARAMS_CACHE.move_to_end(key)
+        return JAVA_PARAMS_CACHE[key]
     if operator == 'BandMaths':
         hm_params = buildTargetBands(params)
     else: 
         hm_params = setProcessingParameters(params)
+    JAVA_PARAMS_CACHE[key] = hm_params
+    if len(JAVA_PARAMS_CACHE) > JAVA_PARAMS_CACHE_SIZE:
+        JAVA_PARAMS_CACHE.popitem(last=False)
+    return hm_params
+
+#General function to execute SNAP functions
+def executeSNAPFunction(product, parameters):
+    operator = parameters[0]['operator']
+    hm_params = javaParameters(operator, parameters[1])
     processed_product = snappy.GPF.createProduct(operator, hm_params, product)
     #Return processed product
     return processed_product
 
-# Compare the coordinates to obtain the min/max values
-def getMinMax(current,minV,maxV):
-	if current < minV:
-		minV = current
-	if current > maxV:
-		maxV = current
-	return [minV, maxV]
-
 def getExtent(myProd):
-	########
-	## Get corner coordinates of the ESA SNAP product (get extent)
-	########
-	# int step - the step given in pixels
-	step = 1
-	minLon = 999.99
-
-	GeoPos = snappy.ProductUtils.createGeoBoundary(myProd, step)
-
-	maxLon = -minLon
-	minLat = minLon
-	maxLat = maxLon
-	for element in GeoPos:
-		try:
-			lon = element.getLon()
-			[minLon, maxLon] = getMinMax(lon,minLon,maxLon)
-		except (NameError):
-			pass
-		try:
-			# TODO: separate method to get min and max
-			lat = element.getLat()
-			[minLat, maxLat] = getMinMax(lat,minLat,maxLat)
-		except (NameError):
-			pass
-
-	return minLon, maxLon, minLat, maxLat
+    ########
+    ## Get corner coordinates of the ESA SNAP product (get extent)
+    ########
+    # Boundary coordinates read in bulk (wqpFootprint)
+    bbox_prod = productBounds(myProd)
+    return bbox_prod['minLon'], bbox_prod['maxLon'], bbox_prod['minLat'], bbox_prod['maxLat']
 
 def trimBbox(bbox, bbox_prod):
     bbox_trim = dict()
@@ -241,4 +285,200 @@ def trimBbox(bbox, bbox_prod):
     return bbox_trim
 
 def exportProductBands(product, out_path, writeFormat):
-    ProductIO.writeProduct(product, out_path, writeFormat)
\ No newline at end of file
+    ProductIO.writeProduct(product, out_path, writeFormat)
+
+"""
+4. GPF GRAPHS
+"""
+# Extension added by the SNAP writers to the output path
+WRITE_EXTENSIONS = {
+    'GeoTIFF': '.tif',
+    'GeoTIFF-BigTIFF': '.tif',
+    'BEAM-DIMAP': '.dim',
+    'NetCDF4-CF': '.nc',
+}
+
+class snapGraph:
+    """
+    GPF graph of a product: a single Read node, the SNAP operators (with the
+    processing parameters in the format of wqpSNAPparams_*) and one Write node for
+    each output. Executing the whole graph lets the GPF tile scheduler compute the
+    tiles shared by several outputs (e.g. the C2RCC product) only once.
+        productPath: path to the product (e.g. xfdumanifest.xml, MTL.txt)
+    """
+    def __init__(self, productPath, formatName=None):
+        self.productPath = productPath
+        self.nodes = OrderedDict()
+        self.outputs = dict() # {source node: output file}
+        params = {'file': productPath}
+        if formatName is not None:
+            params['formatName'] = formatName
+        self.addNode('Read', 'Read', params, [])
+
+    def addNode(self, nodeId, operator, parameters, sources):
+        if nodeId in self.nodes:
+            raise ValueError(f'Duplicated node: {nodeId}')
+        for source in sources:
+            if source not in self.nodes:
+                raise ValueError(f'Unknown source node for {nodeId}: {source}')
+        self.nodes[nodeId] = {'operator': operator, 'parameters': parameters, 'sources': list(sources)}
+
+    def addOperator(self, nodeId, parameters, source='Read'):
+        # parameters: [{'operator': ...}, {processing parameters}] as in executeSNAPFunction
+        self.addNode(nodeId, parameters[0]['operator'], parameters[1], [source])
+
+    def addWrite(self, nodeId, source, out_path, writeFormat='GeoTIFF'):
+        # out_path without extension, as in exportProductBands
+        out_file = out_path + WRITE_EXTENSIONS.get(writeFormat, '')
+        self.addNode(nodeId, 'Write', {'file': out_file, 'formatName': writeFormat}, [source])
+        self.outputs[source] = out_file
+        return out_file
+
+    def usedNodes(self):
+        # Nodes needed by the writes: the nodes without a write are left out of the graph
+        used = set()
+        pending = [nodeId for nodeId, node in self.nodes.items() if node['operator'] == 'Write']
+        while pending:
+            nodeId = pending.pop()
+            if nodeId not in used:
+                used.add(nodeId)
+                pending.extend(self.nodes[nodeId]['sources'])
+        return [nodeId for nodeId in self.nodes if nodeId in used]
+
+    def toXML(self):
+        graph = ET.Element('graph', id='wqpGraph')
+        ET.SubElement(graph, 'version').text = '1.0'
+        for nodeId in self.usedNodes():
+            node = self.nodes[nodeId]
+            xml_node = ET.SubElement(graph, 'node', id=nodeId)
+            ET.SubElement(xml_node, 'operator').text = node['operator']
+            sources = ET.SubElement(xml_node, 'sources')
+            for idx, source in enumerate(node['sources']):
+                tag = 'sourceProduct' if idx == 0 else f'sourceProduct.{idx}'
+                ET.SubElement(sources, tag, refid=source)
+            parameters = ET.SubElement(xml_node, 'parameters')
+            node_params = node['parameters']
+            if node['operator'] == 'BandMaths':
+                node_params = bandMathsParameters(node_params)
+            for key, value in node_params.items():
+                if key in BANDMATHS_LISTS:
+                    # BandMaths target bands and variables: <targetBands><targetBand>...</targetBand></targetBands>
+                    items = ET.SubElement(parameters, key)
+                    for item_params in value:
+                        item = ET.SubElement(items, BANDMATHS_LISTS[key])
+                        for item_key, item_value in item_params.items():
+                            ET.SubElement(item, item_key).text = parameterText(item_value)
+                else:
+                    ET.SubElement(parameters, key).text = parameterText(value)
+        return ET.tostring(graph, encoding='unicode')
+
+    def saveXML(self, xml_path):
+        # Graph file for gpt or the SNAP Graph Builder
+        with open(xml_path, 'w') as f:
+            f.write(self.toXML())
+        return xml_path
+
+    def execute(self):
+        # Execute the graph in the snappy JVM
+        GraphIO = jpy.get_type('org.esa.snap.core.gpf.graph.GraphIO')
+        GraphProcessor = jpy.get_type('org.esa.snap.core.gpf.graph.GraphProcessor')
+        StringReader = jpy.get_type('java.io.StringReader')
+        graph = GraphIO.read(StringReader(self.toXML()))
+        GraphProcessor().executeGraph(graph, ProgressMonitor.NULL)
+
+    def executeGPT(self, xml_path, gptPath='gpt', tileCacheMB=None, threads=None):
+        # Execute the graph with the gpt command line tool (separate JVM)
+        self.saveXML(xml_path)
+        cmd = [gptPath, xml_path]
+        if tileCacheMB is not None:
+            cmd += ['-c', f'{int(tileCacheMB)}M']
+        if threads is not None:
+            cmd += ['-q', str(int(threads))]
+        return subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+# Parameters of the BandMaths operator: lists of <targetBand> and <variable> elements
+BANDMATHS_LISTS = {'targetBands': 'targetBand', 'variables': 'variable'}
+
+def bandMathsParameters(parameters):
+    """
+    BandMaths parameters of the graph XML: only targetBands and variables. The
+    description of the wqpSNAPparams_* parameters is set on the target bands
+    without their own, the name (of the target product) is not a BandMaths
+    parameter and is left out.
+    """
+    description = parameters.get('description')
+    targetBands = [dict(tb, description=description) if description is not None and 'description' not in tb else tb
+                   for tb in parameters.get('targetBands', [])]
+    bandMaths = {'targetBands': targetBands}
+    if 'variables' in parameters:
+        bandMaths['variables'] = parameters['variables']
+    return bandMaths
+
+# Text of a processing parameter in the graph XML
+def parameterText(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
+
+# Output paths (without extension) of the production notebook for each graph output
+def graphOutputPaths(sensor, cwd_path, name):
+    if sensor == 'S3':
+        sensorName = name.split('_')[0]
+        sensorDate = name.split('_')[8]
+        wqp_name = lambda typology: f'{sensorName}_{typology}_IT_{sensorDate}_L1'
+        return {
+            'chl': os.path.join(cwd_path['out_wqp'], 'chl', wqp_name('CHL')),
+            'tsm': os.path.join(cwd_path['out_wqp'], 'tsm', wqp_name('TSM')),
+            'chl_no_clip': os.path.join(cwd_path['out_wqp_no_clip'], 'chl', wqp_name('CHL')),
+            'tsm_no_clip': os.path.join(cwd_path['out_wqp_no_clip'], 'tsm', wqp_name('TSM')),
+            'chl_no_mask': os.path.join(cwd_path['out_wqp_no_mask'], 'chl', wqp_name('CHL')),
+            'tsm_no_mask': os.path.join(cwd_path['out_wqp_no_mask'], 'tsm', wqp_name('TSM')),
+            'chl_cloud_mask': os.path.join(cwd_path['out_wqp_cloud'], 'chl', wqp_name('CHL')),
+            'tsm_cloud_mask': os.path.join(cwd_path['out_wqp_cloud'], 'tsm', wqp_name('TSM')),
+            'masks': os.path.join(cwd_path['out_masks'], f'{sensorName}_IT_{sensorDate}_L1'),
+            'oa': os.path.join(cwd_path['out_oa'], f'{sensorName}_IT_{sensorDate}_L1'),
+            'rrs': os.path.join(cwd_path['out_rrs'], f'{sensorName}_IT_{sensorDate}_L1'),
+        }
+    elif sensor == 'L8':
+        sensorDate = name.split('_')[3]
+        return {
+            'lswt': os.path.join(cwd_path['out_wqp'], 'lswt', f'L8_LSWT_IT_{sensorDate}_L1'),
+            'lswt_mid_high': os.path.join(cwd_path['out_wqp_mid_high_clouds'], 'lswt', f'L8_LSWT_IT_{sensorDate}_L1'),
+            'lswt_high': os.path.join(cwd_path['out_wqp_high_clouds'], 'lswt', f'L8_LSWT_IT_{sensorDate}_L1'),
+        }
+    elif sensor == 'EUMETSAT':
+        sensorName = name.split('_')[0]
+        sensorDate = name.split('_')[7]
+        return {
+            'chl_nn': os.path.join(cwd_path['out_chl_nn'], f'{sensorName}_CHL_IT_{sensorDate}_L1'),
+            'chl_oc4me': os.path.join(cwd_path['out_chl_oc4me'], f'{sensorName}_CHL_IT_{sensorDate}_L1'),
+            'tsm_nn': os.path.join(cwd_path['out_tsm_nn'], f'{sensorName}_TSM_IT_{sensorDate}_L1'),
+        }
+    raise ValueError(f'Unknown sensor: {sensor}')
+
+def buildProductGraph(productPath, wqpParams, out_paths, params=None, writeFormat='GeoTIFF'):
+    """
+    Build the GPF graph of the production chain defined in wqpParams.graph_nodes
+    (wqpSNAPparams_S3, _L8 or _EUMETSAT) with a write for each output.
+        productPath: path to the product
+        wqpParams: module with the processing parameters
+        out_paths: {node id: output path without extension} (e.g. graphOutputPaths)
+        params: {parameters name: parameters} for the scene (e.g. the updated subset,
+                C2RCC temperature or BandMaths expressions), default the module values
+    e.g.
+        s3_image.readSNAPProduct()
+        params = {
+            'params_subset': s3_image.updateSNAPSubset(wqpParams.params_subset),
+            'params_C2RCC': s3_image.updateSNAPTemperature(df_t, wqpParams.params_C2RCC),
+        }
+        out_paths = graphOutputPaths('S3', cwd_path, s3_image.name)
+        graph = buildProductGraph(s3_image.path, wqpParams, out_paths, params)
+        graph.execute()
+    """
+    params = params or dict()
+    graph = snapGraph(productPath)
+    for nodeId, paramsName, source in wqpParams.graph_nodes:
+        graph.addOperator(nodeId, params.get(paramsName, getattr(wqpParams, paramsName)), source)
+    for nodeId, out_path in out_paths.items():
+        graph.addWrite(f'Write_{nodeId}', nodeId, out_path, writeFormat)
+    return graph
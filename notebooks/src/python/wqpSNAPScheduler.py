@@ -0,0 +1,391 @@
+import os
+import time
+import importlib
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+import pandas as pd
+from wqpMeteo import resolveAtmCorr, ATM_CORR_EXPRESSIONS, ATM_CORR_TIME_FORMAT
+
+"""
+SCHEDULER OF THE SNAP PRODUCTION RUNS
+"""
+# JVM of each worker process: maximum heap and GPF tile cache (MB)
+JAVA_MAX_MEM = 8192
+TILE_CACHE = 2048
+# Memory (MB) used by each worker besides the java heap (python, GDAL, native buffers)
+WORKER_OVERHEAD = 1024
+# Memory (MB) of the host that is never assigned to the workers
+RESERVED_MEMORY = 2048
+# Seconds after its start during which the heap of a worker is not yet allocated
+WORKER_WARMUP = 60
+
+# Field of /proc/meminfo in MB (None when /proc/meminfo is not available)
+def meminfo(field):
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def availableMemory():
+    return meminfo('MemAvailable')
+
+def totalMemory():
+    return meminfo('MemTotal')
+
+def javaOptions(javaMaxMem, tileCache, parallelism=None):
+    # Options read by the JVM started by snappy in the worker
+    options = [f'-Xmx{int(javaMaxMem)}m', f'-Dsnap.jai.tileCacheSize={int(tileCache)}']
+    if parallelism is not None:
+        options.append(f'-Dsnap.parallelism={int(parallelism)}')
+    return ' '.join(options)
+
+def sceneWorker(target, task, options, conn):
+    # Entry point of the worker process: the JVM options must be set before snappy is imported
+    os.environ['_JAVA_OPTIONS'] = options
+    try:
+        result = {'outputs': target(task), 'error': None}
+    except Exception as e:
+        result = {'outputs': None, 'error': {
+            'exception': type(e).__name__,
+            'message': str(e),
+            'traceback': traceback.format_exc(),
+        }}
+    conn.send(result)
+    conn.close()
+
+# Product name as parsed by snapProduct
+def sceneName(path):
+    return path.split('/')[-2].split('.')[0]
+
+def readAtmCorr(cwd_path):
+    df_atm = pd.read_csv(os.path.join(cwd_path['in_parameters'], 'atmCorr.csv'))
+    df_atm['DateTime'] = pd.to_datetime(df_atm['DateTime'], format=ATM_CORR_TIME_FORMAT)
+    return df_atm
+
+def bandMathsOutputs(wqpParams, out_paths):
+    # Outputs extracted from the BandMaths node (node id = target band name), removed from out_paths
+    return {nodeId: out_paths.pop(nodeId) for nodeId, paramsName, source in wqpParams.graph_nodes
+            if source == 'BandMaths' and nodeId in out_paths}
+
+def processScene(task):
+    """
+    Production chain of the WQP_Production notebook for a single scene: read the
+    product, update the subset (and the C2RCC temperature for S3 or the atmospheric
+    correction for L8), execute the GPF graph of the sensor and crop the outputs by
+    the lakes extent. With a ledger, the scenes already processed with the same
+    parameters are skipped before the product is read and every run is recorded.
+    Returns the product name, the parameters hash and the written GeoTIFF.
+    """
+    import wqpSNAPFunctions as wqpSNAP
+    from wqpFunctions import wqp
+    from wqpLedger import productionLedger, paramsHash, sceneParameters
+    from wqpMeteo import meteoLookup
+    from wqpFootprint import footprintCache
+    from wqpCube import cubeOutputPath, finalizeCube, splitCube
+    sensor = task['sensor']
+    cwd_path = task['cwd_path']
+    wqpParams = importlib.import_module(f'wqpSNAPparams_{sensor}')
+    image = wqpSNAP.snapProduct(task['path'], task['bbox'])
+    # Scene parameters that do not need the product
+    params = wqpSNAP.sceneParams(wqpParams)
+    if sensor == 'S3':
+        meteo = meteoLookup.fromCSV(os.path.join(cwd_path['in_parameters'], 'meteoTemp.csv'))
+        params = params.derive('params_C2RCC', temperature=wqpSNAP.extractTemp(image.name, meteo))
+    elif sensor == 'L8':
+        expressions = task.get('atmCorr')
+        if expressions is None:
+            expressions = wqpSNAP.extractAtmCorr(image.name, readAtmCorr(cwd_path))
+        params = params.deriveTargetBands('params_bandMaths', expressions)
+    out_paths = wqpSNAP.graphOutputPaths(sensor, cwd_path, image.name)
+    maths_paths = dict()
+    if task.get('pythonBandMaths') and sensor == 'S3':
+        # The BandMaths variants are computed from the sources output by wqpBandMaths
+        maths_paths = bandMathsOutputs(wqpParams, out_paths)
+        out_paths['sources'] = os.path.join(cwd_path['out_sources'], os.path.basename(out_paths['masks']))
+    cube_paths = dict()
+    if task.get('cube') and sensor == 'S3':
+        # The BandMaths variants are written once as the bands of the cube
+        cube_paths = bandMathsOutputs(wqpParams, out_paths)
+        targetBands = [tb for tb in params['params_bandMaths'][1]['targetBands'] if tb['name'] in cube_paths]
+        params = params.derive('params_bandMaths', targetBands=targetBands)
+        out_paths['BandMaths'] = cubeOutputPath(cwd_path, image.name)
+    sceneHash = paramsHash(sceneParameters(wqpParams, params, task['bbox'], task['writeFormat'],
+                                           list(out_paths) + list(maths_paths) + list(cube_paths if task.get('splitCube') else [])))
+    ledger = productionLedger(task['ledger']) if task.get('ledger') is not None else None
+    result = {'name': image.name, 'paramsHash': sceneHash, 'skipped': False}
+    if ledger is not None and ledger.isCurrent(image.name, sceneHash):
+        result['outputs'] = ledger.entry(image.name)['outputs']
+        result['skipped'] = True
+        ledger.close()
+        return result
+    try:
+        image.readSNAPProduct(footprintCache(task['footprints']) if task.get('footprints') is not None else None)
+        if not image.intersects:
+            # The product does not cover the ROI: recorded so that it is not read again with the same parameters
+            image.product.dispose()
+            result.update(outputs=[], skipped=True)
+            if ledger is not None:
+                ledger.record(image.name, sensor, task['path'], sceneHash, [], status='skipped')
+                ledger.close()
+            return result
+        try:
+            params = params.derive('params_subset', geoRegion=image.subsetRegion())
+            for out_path in list(out_paths.values()) + list(maths_paths.values()):
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            graph = wqpSNAP.buildProductGraph(image.path, wqpParams, out_paths, params, task['writeFormat'])
+            graph.execute()
+        finally:
+            image.product.dispose()
+        outputs = [out_file for nodeId, out_file in graph.outputs.items() if nodeId != 'sources']
+        if maths_paths:
+            from wqpBandMaths import bandMaths
+            sources = graph.outputs['sources']
+            maths = bandMaths(params['params_bandMaths'][1]['targetBands'])
+            written = maths.evaluateRaster(sources, {band: out_path + '.tif' for band, out_path in maths_paths.items()},
+                                           sourceNames=[tb['name'] for tb in params['params_bandMaths_sources'][1]['targetBands']])
+            os.remove(sources)
+            outputs += list(written.values())
+        if task['featureGeometry'] is not None:
+            for out_file in outputs:
+                mb = wqp(out_file)
+                mb.readWQP()
+                mb.cropRasterByFeatures(task['featureGeometry'], task['nameField'])
+                mb.saveMaskedImageMultiband(out_file, 'wqp')
+                mb.closeWQP()
+        if cube_paths:
+            names = [tb['name'] for tb in params['params_bandMaths'][1]['targetBands']]
+            finalizeCube(graph.outputs['BandMaths'], names, task['cubePreset'])
+            if task['splitCube']:
+                outputs += list(splitCube(graph.outputs['BandMaths'], names, cube_paths).values())
+    except Exception as e:
+        if ledger is not None:
+            ledger.record(image.name, sensor, task['path'], sceneHash, None, status='failed', error=f'{type(e).__name__}: {e}')
+            ledger.close()
+        raise
+    if ledger is not None:
+        ledger.record(image.name, sensor, task['path'], sceneHash, outputs)
+        ledger.close()
+    result['outputs'] = outputs
+    return result
+
+class sceneRun:
+    """
+    Iterable over the results of processScenes. Each scene is processed in its own
+    worker process (own snappy JVM, heap and tile cache); at most `workers` scenes
+    run at the same time, capped by the number of workers that fit in the memory of
+    the host, and a new scene is started only if the available memory, less the
+    memory promised to the workers that are still starting, is enough for another
+    worker. The
+    workers that crash (e.g. the JVM is killed) are started again up to `retries`
+    times; the failures are collected in errors and can be exported with errorReport.
+    """
+    def __init__(self, tasks, target, workers, javaMaxMem, tileCache, parallelism, retries, reservedMemory,
+                 errors=None, poll=1.0):
+        self.tasks = list(tasks)
+        self.target = target
+        self.workerMemory = javaMaxMem + WORKER_OVERHEAD
+        self.reservedMemory = reservedMemory
+        self.workers = self.maxWorkers(workers)
+        self.options = javaOptions(javaMaxMem, tileCache, parallelism)
+        self.retries = retries
+        self.poll = poll
+        self.errors = list(errors or [])
+        self.discarded = []
+        self.processed = 0
+
+    def maxWorkers(self, workers):
+        # Workers that fit in the memory of the host (at least one)
+        total = totalMemory()
+        if total is None:
+            return workers
+        return max(1, min(workers, int((total - self.reservedMemory) // self.workerMemory)))
+
+    def admit(self, running):
+        # Memory admission: the heap of the workers started less than WORKER_WARMUP seconds
+        # ago is not yet allocated (not in MemAvailable), so their memory is subtracted
+        if not running:
+            return True
+        available = availableMemory()
+        if available is None:
+            return True
+        warming = sum(1 for w in running if time.time() - w['start'] < WORKER_WARMUP)
+        return available - self.reservedMemory - warming * self.workerMemory >= self.workerMemory
+
+    def start(self, ctx, task, attempt):
+        receiver, sender = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=sceneWorker, args=(self.target, task, self.options, sender))
+        process.start()
+        sender.close()
+        return {'task': task, 'attempt': attempt, 'process': process, 'conn': receiver, 'result': None, 'start': time.time()}
+
+    def __iter__(self):
+        # spawn: the workers do not inherit the JVM (or its state) of the parent process
+        ctx = multiprocessing.get_context('spawn')
+        pending = [(task, 0) for task in self.tasks]
+        running = []
+        try:
+            while pending or running:
+                while pending and len(running) < self.workers and self.admit(running):
+                    task, attempt = pending.pop(0)
+                    running.append(self.start(ctx, task, attempt))
+                ready = wait([w['conn'] for w in running] + [w['process'].sentinel for w in running], self.poll)
+                for w in list(running):
+                    if w['result'] is None and w['conn'] in ready:
+                        w['result'] = self.receive(w['conn'])
+                    if w['process'].sentinel not in ready:
+                        continue
+                    w['process'].join()
+                    if w['result'] is None and w['conn'].poll():
+                        w['result'] = self.receive(w['conn'])
+                    w['conn'].close()
+                    running.remove(w)
+                    if w['result'] is None and w['attempt'] < self.retries:
+                        pending.append((w['task'], w['attempt'] + 1))
+                        continue
+                    yield from self.collect(w)
+        finally:
+            for w in running:
+                w['process'].terminate()
+                w['process'].join()
+
+    def receive(self, conn):
+        # Result sent by the worker (None if the worker died before sending it)
+        try:
+            return conn.recv()
+        except EOFError:
+            return None
+
+    def collect(self, w):
+        self.processed += 1
+        task = w['task']
+        result = w['result']
+        if result is None:
+            # The worker died without a result
+            result = {'outputs': None, 'error': {
+                'exception': 'WorkerCrash',
+                'message': f"exit code {w['process'].exitcode}",
+                'traceback': '',
+            }}
+        if result['error'] is not None:
+            self.errors.append(dict(path=task['path'], attempts=w['attempt'] + 1, **result['error']))
+        else:
+            row = {'path': task['path'], 'attempts': w['attempt'] + 1, 'seconds': time.time() - w['start']}
+            if isinstance(result['outputs'], dict):
+                row.update(result['outputs'])
+            else:
+                row['outputs'] = result['outputs']
+            yield row
+
+    def toDataFrame(self):
+        # Run all the scenes and return the processed ones in a single dataframe
+        return pd.DataFrame(list(self))
+
+    def errorReport(self, out_path=None):
+        # Failures as a dataframe (optionally saved as csv)
+        df = pd.DataFrame(self.errors, columns=['path', 'attempts', 'exception', 'message', 'traceback'])
+        if out_path is not None:
+            df.to_csv(out_path, index=False)
+        return df
+
+def processScenes(paths, sensor, bbox, cwd_path, featureGeometry=None, nameField='Nome', writeFormat='GeoTIFF',
+                  workers=2, javaMaxMem=JAVA_MAX_MEM, tileCache=TILE_CACHE, parallelism=None, retries=1,
+                  reservedMemory=RESERVED_MEMORY, ledger=None, footprints=None, pythonBandMaths=False,
+                  cube=False, cubePreset='deflate', splitCube=True, target=processScene):
+    """
+    Run the SNAP production chain (processScene) over a list of scenes in parallel
+    worker processes.
+        paths: products to process (e.g. .../xfdumanifest.xml for S3, ..._MTL.txt for L8)
+        sensor: 'S3', 'L8' or 'EUMETSAT'
+        bbox: ROI bounding box (as in snapProduct)
+        cwd_path: working folders (inputParameters)
+        featureGeometry: lakes extent used to crop the outputs (None: no crop)
+        workers: maximum number of scenes processed at the same time
+        javaMaxMem: java heap (MB) of each worker
+        tileCache: GPF tile cache (MB) of each worker
+        parallelism: GPF threads of each worker (default: number of cpus)
+        retries: number of times a crashed worker is started again
+        reservedMemory: memory (MB) of the host never assigned to the workers
+        ledger: path to the production ledger (wqpLedger). The scenes processed with the
+                same parameters are skipped (skipped column) and every run is recorded,
+                also the scenes outside bbox (status skipped)
+        footprints: path to the footprints cache (wqpFootprint). The scenes with a cached
+                    footprint outside bbox are not processed (listed in discarded)
+        pythonBandMaths: (S3) SNAP writes only the C2RCC concentrations and flags
+                         (params_bandMaths_sources) and the chl/tsm variants of
+                         params_bandMaths are computed from them with wqpBandMaths
+        cube: (S3) the chl/tsm variants are written as the bands of a single product
+              (out_cube, GeoTIFF with band descriptions or NetCDF4-CF) instead of
+              one product per variant. The NetCDF4-CF cube is not cropped, so it
+              needs featureGeometry=None
+        cubePreset: layout of the GeoTIFF cube (see wqpFunctions.OUTPUT_PRESETS)
+        splitCube: with cube, the legacy layout (out_wqp/chl, ...) is written as VRTs
+                   that read the bands of the cube
+        target: function executed for each scene with the task dictionary
+    The L8 scenes without atmospheric correction parameters are reported in errors
+    (MissingAtmCorr) without being processed.
+    Returns a sceneRun that yields the scenes as they are finished, e.g.
+        run = processScenes(paths, 'S3', bbox, cwd_path, featureGeometry, workers=3, javaMaxMem=12000,
+                            ledger=os.path.join(cwd_path['out'], 'ledger.sqlite'))
+        df = run.toDataFrame()
+        run.errorReport(os.path.join(cwd_path['out'], 'error_images_S3.csv'))
+    """
+    tasks = [{
+        'path': path,
+        'sensor': sensor,
+        'bbox': bbox,
+        'cwd_path': cwd_path,
+        'featureGeometry': featureGeometry,
+        'nameField': nameField,
+        'writeFormat': writeFormat,
+        'ledger': ledger,
+        'footprints': footprints,
+        'pythonBandMaths': pythonBandMaths,
+        'cube': cube,
+        'cubePreset': cubePreset,
+        'splitCube': splitCube,
+    } for path in paths]
+    if pythonBandMaths and cube:
+        raise ValueError('Select either pythonBandMaths or cube')
+    if cube:
+        from wqpCube import CUBE_FORMATS
+        if writeFormat not in CUBE_FORMATS:
+            raise ValueError(f'The cube can be written as {list(CUBE_FORMATS)}, not {writeFormat}')
+        if featureGeometry is not None and CUBE_FORMATS[writeFormat] == '.nc':
+            # The crop (wqp.saveMaskedImageMultiband) writes GeoTIFF files
+            raise ValueError(f'The {writeFormat} cube cannot be cropped by featureGeometry: '
+                             'use a GeoTIFF writeFormat or featureGeometry=None')
+    if pythonBandMaths and not writeFormat.startswith('GeoTIFF'):
+        raise ValueError(f'pythonBandMaths needs a GeoTIFF writeFormat, not {writeFormat}')
+    rejected = []
+    discarded = []
+    if footprints is not None:
+        from wqpFootprint import footprintCache
+        kept, discarded = footprintCache(footprints).screen(paths, bbox)
+        kept = set(kept)
+        tasks = [task for task in tasks if task['path'] in kept]
+        if ledger is not None and discarded:
+            # The parameters of the discarded scenes are never computed: recorded with the hash of the ROI
+            from wqpLedger import productionLedger, paramsHash
+            ledgerDB = productionLedger(ledger)
+            for path in discarded:
+                ledgerDB.record(sceneName(path), sensor, path, paramsHash({'bbox': bbox}), [], status='skipped')
+            ledgerDB.close()
+    if sensor == 'L8':
+        # Atmospheric correction of all the scenes before starting any worker
+        atm = resolveAtmCorr([sceneName(task['path']) for task in tasks], readAtmCorr(cwd_path))
+        for task, (name, row) in zip(list(tasks), atm.iterrows()):
+            if row['missing']:
+                tasks.remove(task)
+                rejected.append({'path': task['path'], 'attempts': 0, 'exception': 'MissingAtmCorr',
+                                 'message': f"There are no atmosferic correction parameters for {name} ({row['date'].date()})",
+                                 'traceback': ''})
+            else:
+                task['atmCorr'] = {band: row[band] for band in ATM_CORR_EXPRESSIONS}
+    run = sceneRun(tasks, target, workers, javaMaxMem, tileCache, parallelism, retries, reservedMemory, rejected)
+    run.discarded = discarded
+    return run
@@ -153,4 +153,16 @@ params_bandExtractor_tsm_nn = [
     {
         "sourceBandNames":"tsm_nn",
     }
-]
\ No newline at end of file
+]
+
+# 7. GPF graph of the production chain: (node id, processing parameters, source node)
+# The graph is read once and the nodes without a write are not computed
+graph_nodes = [
+    ('Subset', 'params_subset', 'Read'),
+    ('Reproject', 'params_reproject', 'Subset'),
+    ('ImportVector', 'params_importVector', 'Reproject'),
+    ('BandMaths', 'params_bandMaths', 'ImportVector'),
+    ('chl_nn', 'params_bandExtractor_chl_nn', 'BandMaths'),
+    ('chl_oc4me', 'params_bandExtractor_chl_oc4me', 'BandMaths'),
+    ('tsm_nn', 'params_bandExtractor_tsm_nn', 'BandMaths'),
+]
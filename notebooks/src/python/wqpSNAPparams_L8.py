@@ -161,4 +161,18 @@ params_bandExtractor_masks = [
     },
     { "sourceBandNames":"cloud_confidence_mid,cloud_confidence_high,cloud_shadow_confidence_mid,cloud_shadow_confidence_high,cirrus_confidence_mid,cirrus_confidence_high"
     }
-]
\ No newline at end of file
+]
+
+# 7. GPF graph of the production chain: (node id, processing parameters, source node)
+# The graph is read once and the nodes without a write are not computed
+graph_nodes = [
+    ('Subset', 'params_subset', 'Read'),
+    ('Resample', 'params_resample', 'Subset'),
+    ('ImportVector', 'params_importVector', 'Resample'),
+    ('BandMaths', 'params_bandMaths', 'ImportVector'),
+    ('BandMaths_masks', 'params_bandMaths_masks', 'ImportVector'),
+    ('lswt', 'params_bandExtractor_lswt', 'BandMaths'),
+    ('lswt_mid_high', 'params_bandExtractor_lswt_mid_high', 'BandMaths'),
+    ('lswt_high', 'params_bandExtractor_lswt_high', 'BandMaths'),
+    ('masks', 'params_bandExtractor_masks', 'BandMaths_masks'),
+]
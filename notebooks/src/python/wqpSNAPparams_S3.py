@@ -411,6 +411,25 @@ params_bandMaths_masks = [
         }
     ]
 
+# C2RCC concentrations and flags used by the params_bandMaths expressions, exported
+# once so the chl/tsm variants can be computed in Python (wqpBandMaths)
+params_bandMaths_sources = [
+        {
+            'operator':'BandMaths'
+        },
+        {
+            'name' : 'sources',
+            'description' : 'params_bandMaths sources',
+            'targetBands' : [
+                {
+                    'name' : band,
+                    'type' : 'float32',
+                    'expression' : band,
+                } for band in ['conc_chl', 'conc_tsm', 'rtoa_15', 'simile_laghi', 'Cloud_risk', 'Rtosa_OOS', 'Rtosa_OOR', 'Rhow_OOR']
+            ]
+        }
+    ]
+
 # 6. Extract bands from products
 
 # Extract water surface reflectance bands
@@ -528,4 +547,29 @@ params_bandExtractor_tsm_cloud_mask = [
     {
         "sourceBandNames":"tsm_cloud_mask",
     }
-]
\ No newline at end of file
+]
+
+# 7. GPF graph of the production chain: (node id, processing parameters, source node)
+# The graph is read once and the nodes without a write are not computed
+graph_nodes = [
+    ('Subset', 'params_subset', 'Read'),
+    ('Reproject', 'params_reproject', 'Subset'),
+    ('C2RCC', 'params_C2RCC', 'Reproject'),
+    ('ImportVector', 'params_importVector', 'C2RCC'),
+    ('BandMaths', 'params_bandMaths', 'ImportVector'),
+    ('BandMaths_oa', 'params_bandMaths_oa', 'Reproject'),
+    ('BandMaths_rrs', 'params_bandMaths_rrs', 'ImportVector'),
+    ('BandMaths_masks', 'params_bandMaths_masks', 'ImportVector'),
+    ('sources', 'params_bandMaths_sources', 'ImportVector'),
+    ('chl', 'params_bandExtractor_chl', 'BandMaths'),
+    ('tsm', 'params_bandExtractor_tsm', 'BandMaths'),
+    ('chl_no_clip', 'params_bandExtractor_chl_no_clip', 'BandMaths'),
+    ('tsm_no_clip', 'params_bandExtractor_tsm_no_clip', 'BandMaths'),
+    ('chl_no_mask', 'params_bandExtractor_chl_no_masks', 'BandMaths'),
+    ('tsm_no_mask', 'params_bandExtractor_tsm_no_masks', 'BandMaths'),
+    ('chl_cloud_mask', 'params_bandExtractor_chl_cloud_mask', 'BandMaths'),
+    ('tsm_cloud_mask', 'params_bandExtractor_tsm_cloud_mask', 'BandMaths'),
+    ('oa', 'params_bandExtractor_oa', 'BandMaths_oa'),
+    ('rrs', 'params_bandExtractor_rrs', 'BandMaths_rrs'),
+    ('masks', 'params_bandExtractor_masks', 'BandMaths_masks'),
+]
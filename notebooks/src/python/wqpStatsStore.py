@@ -0,0 +1,186 @@
+import os
+import time
+import uuid
+import shutil
+import numpy as np
+import pandas as pd
+
+"""
+PARTITIONED STATISTICS STORE
+"""
+# Partitions of the store (folders sensor=.../typology=.../year=...)
+PARTITION_COLUMNS = ['sensor', 'typology', 'year']
+# Key of a row: a product has one row for each statistic method
+KEY_COLUMNS = ['name', 'method']
+# Method of the statistics without outlier rejection (exportWQPFormatStats)
+STATS_METHOD = 'stats'
+# Write time of the rows (the last written row of a key is the current one)
+WRITTEN_COLUMN = '_written'
+
+def statsMethod(df):
+    """
+    Statistic method of each row of an exported statistics dataframe: the
+    Method_{feature} value of the outlier rejection statistics
+    (exportWQPFormatStatsOutliers) or STATS_METHOD.
+    """
+    methods = [c for c in df.columns if c.startswith('Method_')]
+    if not methods:
+        return pd.Series(STATS_METHOD, index=df.index)
+    method = df[methods].bfill(axis=1).iloc[:, 0]
+    return method.where(method.notna(), STATS_METHOD).astype(str)
+
+def basinColumns(columns, basins):
+    # Statistics columns ({stat}_{basin}) of some basins
+    return [c for c in columns if any(c.endswith(f'_{basin}') for basin in basins)]
+
+def latestRows(df):
+    # Last written row of each key
+    df = df.sort_values(WRITTEN_COLUMN, kind='mergesort')
+    return df.drop_duplicates(KEY_COLUMNS, keep='last')
+
+class statsStore:
+    """
+    Statistics of the wqp products (exportWQPFormatStats/Outliers, statsAccumulator)
+    stored as Parquet files partitioned by sensor, typology and year, replacing the
+    lakesStats_*.csv files of appendStatsFile. Each write adds a file to the
+    partitions of its rows; a row is identified by the product name and the
+    statistic method, so writing the same products again replaces their rows
+    (the last written one is read). compact() merges the files of each partition.
+    Reads prune the partitions and columns and filter the dates in pyarrow, e.g.
+        store = statsStore('./out/istSOS/stats')
+        store.write(df)
+        df = store.read(typology=['CHL', 'TSM'], start='2019-01-01', basins=['CO_E', 'CO_N'])
+        root: folder of the store
+    """
+    def __init__(self, root):
+        self.root = root
+        self.lastWritten = 0
+        os.makedirs(root, exist_ok=True)
+
+    def partitionPath(self, sensor, typology, year):
+        return os.path.join(self.root, f'sensor={sensor}', f'typology={typology}', f'year={year}')
+
+    def partitions(self):
+        # Folders of the partitions with their parquet files
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            files = sorted(f for f in filenames if f.endswith('.parquet'))
+            if files:
+                yield dirpath, [os.path.join(dirpath, f) for f in files]
+
+    def writeFile(self, table, folder, prefix='part'):
+        import pyarrow.parquet as pq
+        os.makedirs(folder, exist_ok=True)
+        name = f'{prefix}-{uuid.uuid4().hex}.parquet'
+        tmp_path = os.path.join(folder, f'.{name}.tmp')
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, os.path.join(folder, name))
+        return os.path.join(folder, name)
+
+    def write(self, df):
+        """
+        Add (or replace) the statistics of a dataframe with the columns of
+        exportWQPFormatStats (name, sensor, typology, date and the statistics).
+        Returns the number of rows written by partition.
+        """
+        import pyarrow as pa
+        df = df.reset_index(drop=True).copy()
+        df['date'] = pd.to_datetime(df['date'])
+        df['method'] = statsMethod(df)
+        df['year'] = df['date'].dt.year
+        # Rows without a partition would be dropped by the groupby
+        missing = df[PARTITION_COLUMNS].isna()
+        if missing.any().any():
+            counts = ', '.join(f'{column} ({n} rows)' for column, n in missing.sum().items() if n)
+            raise ValueError(f'Statistics without partition values: {counts}')
+        # Increasing write time, also for writes within the clock resolution
+        self.lastWritten = max(int(time.time() * 1e9), self.lastWritten + 1)
+        df[WRITTEN_COLUMN] = np.int64(self.lastWritten)
+        written = dict()
+        for (sensor, typology, year), part in df.groupby(PARTITION_COLUMNS, sort=False, dropna=False):
+            part = part.drop(columns=PARTITION_COLUMNS).drop_duplicates(KEY_COLUMNS, keep='last')
+            table = pa.Table.from_pandas(part, preserve_index=False)
+            self.writeFile(table, self.partitionPath(sensor, typology, year))
+            written[(sensor, typology, year)] = len(part)
+        return written
+
+    def dataset(self):
+        # pyarrow dataset of all the files, with the union of their columns
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        partitioning = ds.partitioning(pa.schema([('sensor', pa.string()), ('typology', pa.string()), ('year', pa.int32())]), flavor='hive')
+        dataset = ds.dataset(self.root, format='parquet', partitioning=partitioning)
+        schemas = [fragment.physical_schema for fragment in dataset.get_fragments()]
+        if not schemas:
+            return None
+        schema = pa.unify_schemas(schemas + [partitioning.schema])
+        return ds.dataset(self.root, format='parquet', partitioning=partitioning, schema=schema)
+
+    def read(self, columns=None, sensor=None, typology=None, method=None, start=None, end=None, basins=None, latest=True):
+        """
+        Statistics as a dataframe. Only the partitions, columns and rows selected
+        are read from the files.
+            columns: statistics columns (default all); the key, date and partition
+                     columns are always read
+            sensor, typology, method: value or list of values
+            start, end: date range (end included)
+            basins: basins of the statistics columns (e.g. ['CO_E', 'MA'])
+            latest: only the last written row of each product and method
+        """
+        import pyarrow.dataset as ds
+        dataset = self.dataset()
+        if dataset is None:
+            return pd.DataFrame()
+        flt = None
+        for column, values in [('sensor', sensor), ('typology', typology), ('method', method)]:
+            if values is None:
+                continue
+            values = [values] if isinstance(values, str) else list(values)
+            condition = ds.field(column).isin(values)
+            flt = condition if flt is None else flt & condition
+        for op, value in [('>=', start), ('<=', end)]:
+            if value is None:
+                continue
+            value = pd.Timestamp(value)
+            # The year partitions outside the range are not read
+            yearCondition = ds.field('year') >= value.year if op == '>=' else ds.field('year') <= value.year
+            dateCondition = ds.field('date') >= value.to_pydatetime() if op == '>=' else ds.field('date') <= value.to_pydatetime()
+            condition = yearCondition & dateCondition
+            flt = condition if flt is None else flt & condition
+        names = dataset.schema.names
+        meta = ['name', 'path', 'method', 'date', 'sensor', 'typology', 'crs', 'year', WRITTEN_COLUMN]
+        stats = [c for c in names if c not in meta]
+        if columns is not None:
+            stats = [c for c in stats if c in columns]
+        if basins is not None:
+            stats = basinColumns(stats, basins)
+        table = dataset.to_table(columns=[c for c in meta if c in names] + stats, filter=flt)
+        df = table.to_pandas()
+        if latest:
+            df = latestRows(df)
+        return df.drop(columns=[WRITTEN_COLUMN, 'year']).sort_values(['date', 'name']).reset_index(drop=True)
+
+    def compact(self):
+        """
+        Merge the files of each partition in a single file with the last written
+        row of each product and method. Returns the number of rows by partition.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        compacted = dict()
+        for folder, files in list(self.partitions()):
+            if len(files) == 1:
+                compacted[folder] = pq.read_metadata(files[0]).num_rows
+                continue
+            tables = [pq.read_table(f) for f in files]
+            schema = pa.unify_schemas([t.schema for t in tables])
+            df = pd.concat([t.to_pandas() for t in tables], ignore_index=True, sort=False)
+            df = latestRows(df)
+            self.writeFile(pa.Table.from_pandas(df, schema=schema, preserve_index=False), folder, prefix='compact')
+            for f in files:
+                os.remove(f)
+            compacted[folder] = len(df)
+        return compacted
+
+    def clear(self):
+        shutil.rmtree(self.root)
+        os.makedirs(self.root, exist_ok=True)
@@ -1,10 +1,14 @@
 import os
+import copy
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-import geopandas as gpd
 import json
 import pytz
 import requests
-import json
+from requests.adapters import HTTPAdapter
 
 class istSOSClient:
     WQP_PROCEDURES = ['CHL','TURB','TEMP']
@@ -115,7 +119,21 @@ class istSOSClient:
         },
     }
     
-    def __init__(self, HOST, HEADERS, SERVICE, PROCEDURE_LAKE, ENV_FILE):
+    # Seconds before the token expiry when the token is refreshed
+    TOKEN_REFRESH_MARGIN = 30
+    # Status codes of the requests that are retried (server busy or unavailable)
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, HOST, HEADERS, SERVICE, PROCEDURE_LAKE, ENV_FILE, workers=8, retries=3, backoff=0.5, timeout=100):
+        """
+        Client of the istSOS REST API of a lake. The requests share a keep-alive
+        session (pool of connections), the token is refreshed before its expiry
+        (expires_in of the OpenID response) and each request is retried with an
+        exponential backoff on connection errors, busy server and expired token.
+            workers: requests sent at the same time (e.g. getProcedureIDs)
+            retries: attempts after the first one
+            backoff: seconds before the first retry (doubled at each attempt)
+        """
         with open(ENV_FILE, 'r') as f:
             payload = json.load(f)
         TOKEN_URL = f'{HOST}/auth/realms/istsos/protocol/openid-connect/token'
@@ -125,10 +143,29 @@ class istSOSClient:
         self.tokenUrl = TOKEN_URL
         self.apiEndpoint = API_ENDPOINT
         self.procedures = self.PROCEDURES[PROCEDURE_LAKE]
-        
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.authToken = None
+        self.tokenExpiry = None
+        self.tokenLock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
     def updateBearerToken(self):
-        response = requests.post(self.tokenUrl, data=self.payload, headers=self.headers)
-        self.authToken = response.json()['access_token']
+        response = self.session.post(self.tokenUrl, data=self.payload, headers=self.headers, timeout=self.timeout)
+        response.raise_for_status()
+        token = response.json()
+        self.authToken = token['access_token']
+        # Without expires_in the token is refreshed only when the server rejects it
+        expiresIn = token.get('expires_in')
+        self.tokenExpiry = time.monotonic() + float(expiresIn) if expiresIn is not None else None
         self.apiCallBT()
     
     def apiCallBT(self):
@@ -137,28 +174,81 @@ class istSOSClient:
             'Authorization' : f'Bearer {self.authToken}'
         }
 
-    def getProcedureIDs(self):
-        ASSIGNED_SENSOR_ID = dict()
-        for PROCEDURE in  self.procedures:
-            print(PROCEDURE)
-            url_test = f"{self.apiEndpoint}/procedures/{PROCEDURE}"
-            resp = requests.get(url_test, headers=self.requestHeaders, timeout=100)
-            if (resp.status_code==200):
-                try:
-                    ASSIGNED_SENSOR_ID[PROCEDURE] = resp.json()['data']['assignedSensorId']
-                except:
-                    ASSIGNED_SENSOR_ID[PROCEDURE] = ''
-                    print('The procedure {} has not been provided with an ID.'.format(PROCEDURE))
-            elif(resp.status_code==401 and resp.json()['message']=='Signature has expired'):
+    def tokenExpired(self):
+        if self.authToken is None:
+            return True
+        return self.tokenExpiry is not None and time.monotonic() >= self.tokenExpiry - self.TOKEN_REFRESH_MARGIN
+
+    def validToken(self, rejected=None):
+        # Current token, refreshed once by the first thread that finds it expired (or rejected by the server)
+        with self.tokenLock:
+            if self.tokenExpired() or (rejected is not None and rejected == self.authToken):
+                if rejected is not None:
+                    print('Updating authentication token.\n')
                 self.updateBearerToken()
-                print('Updating authentication token.\n')
-                self.getProcedureIDs()
-        return ASSIGNED_SENSOR_ID
+            return self.authToken
+
+    def request(self, method, url, **kwargs):
+        """
+        Authenticated request through the session. A 401 response refreshes the token
+        and the connection errors or RETRY_STATUS responses are retried after
+        backoff * 2**attempt seconds. Returns the last response.
+        A callable data is called at each attempt (e.g. a generator of the body).
+        With idempotent=False (e.g. insertobservation) only the 401 responses are
+        retried: a failed request may have been applied, the caller checks it.
+        """
+        if not url.startswith('http'):
+            url = self.apiEndpoint + url
+        kwargs.setdefault('timeout', self.timeout)
+        data = kwargs.pop('data', None)
+        idempotent = kwargs.pop('idempotent', True)
+        for attempt in range(self.retries + 1):
+            kwargs['data'] = data() if callable(data) else data
+            token = self.validToken()
+            headers = dict(kwargs.pop('headers', None) or {'Content-Type': 'application/json'})
+            headers['Authorization'] = f'Bearer {token}'
+            kwargs['headers'] = headers
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries or not idempotent:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+            if attempt == self.retries:
+                return response
+            if response.status_code == 401:
+                self.validToken(rejected=token)
+            elif response.status_code in self.RETRY_STATUS and idempotent:
+                time.sleep(self.backoff * 2 ** attempt)
+            else:
+                return response
+        return response
+
+    def getProcedureID(self, PROCEDURE):
+        resp = self.request('GET', f'/procedures/{PROCEDURE}')
+        if resp.status_code != 200:
+            print(f'The procedure {PROCEDURE} could not be retrieved ({resp.status_code}).')
+            return None
+        try:
+            return resp.json()['data']['assignedSensorId']
+        except (ValueError, KeyError, TypeError):
+            print('The procedure {} has not been provided with an ID.'.format(PROCEDURE))
+            return ''
+
+    def getProcedureIDs(self):
+        # Assigned sensor id of every procedure of the lake (workers requests at the same time),
+        # None for the procedures that could not be retrieved
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            ids = dict(zip(self.procedures, executor.map(self.getProcedureID, self.procedures)))
+        failed = [PROCEDURE for PROCEDURE, ID in ids.items() if ID is None]
+        if failed:
+            print(f'{len(failed)} of {len(ids)} procedures could not be retrieved: {", ".join(failed)}')
+        return ids
     
     def getRequestSample(self, PROCEDURE):
         apiRequest = f'/operations/getobservation/offerings/temporary/procedures/{PROCEDURE}/observedproperties/:/eventtime/last'
-        response = requests.get(self.apiEndpoint+apiRequest, 
-                    headers = self.requestHeaders)
+        response = self.request('GET', apiRequest)
         data = response.json()
         if data['success'] == True:
             print(data['message'])
@@ -167,20 +257,106 @@ class istSOSClient:
             print(data['message'])
         
         return data
+
+    def insertObservations(self, PROCEDURE, AssignedSensorId, df, STATISTIC=None, chunkSize=None, incremental=True):
+        """
+        Upload the statistics of a procedure (lakesStats dataframe with date, typology
+        and {STATISTIC}_{BASIN} columns) with one insertobservation request for each
+        chunk of chunkSize dates (default CHUNK_SIZE). With incremental, only the dates after the last
+        observation of the procedure on the server (getRequestSample) are sent.
+        A chunk that fails with a RETRY_STATUS response or a connection error may
+        have been inserted: before it is sent again the last observation is read
+        and only the dates after it are sent.
+        Returns a summary dictionary (last server time, dates and chunks sent).
+        """
+        STATISTIC = STATISTIC or procedureStatistic(PROCEDURE)
+        dataSample = self.getRequestSample(PROCEDURE)
+        observation, wqps = observationTemplate(dataSample, self.WQP_DEFINITIONS, self.WQP_PROCEDURES, PROCEDURE)
+        BASIN = procedureBasin(PROCEDURE, STATISTIC)
+        last = lastEventTime(dataSample) if incremental else None
+        df = df.loc[df['typology'].isin([WQP_TYPOLOGIES[wqp] for wqp in wqps])]
+        if last is not None:
+            df = df.loc[df['date'] > last]
+        summary = {'procedure': PROCEDURE, 'statistic': STATISTIC, 'last': last, 'dates': 0, 'chunks': 0}
+        for chunk in dateChunks(df, chunkSize or CHUNK_SIZE):
+            values = resultsWQPvalues(chunk, wqps, BASIN, STATISTIC)
+            if not values:
+                continue
+            response = self.postObservation(PROCEDURE, observation, values, AssignedSensorId)
+            # None: the chunk was inserted by a request that failed
+            if response is not None:
+                result = response.json() if response.status_code == 200 else {'success': False, 'message': response.text}
+                if not result.get('success', False):
+                    raise requests.HTTPError(f"{PROCEDURE} ({values[0][0]} - {values[-1][0]}): {result.get('message')}", response=response)
+            summary['dates'] += len(values)
+            summary['chunks'] += 1
+        return summary
+
+    def postObservation(self, PROCEDURE, observation, values, AssignedSensorId):
+        """
+        insertobservation request of a chunk of values, with a Content-Length body
+        (the chunked transfer encoding is not accepted by istSOS under mod_wsgi).
+        The failed requests are retried with the values after the last observation
+        on the server. Returns the last response, None if the whole chunk has been
+        inserted by a failed request.
+        """
+        for attempt in range(self.retries + 1):
+            observation['samplingTime'] = {'beginPosition': values[0][0], 'endPosition': values[-1][0]}
+            body = b''.join(streamObservation(observation, values, AssignedSensorId))
+            try:
+                response = self.request('POST', '/operations/insertobservation', data=body, idempotent=False)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                response = None
+            if attempt == self.retries or (response is not None and response.status_code not in self.RETRY_STATUS):
+                return response
+            time.sleep(self.backoff * 2 ** attempt)
+            values = valuesAfter(values, lastEventTime(self.getRequestSample(PROCEDURE)))
+            if not values:
+                return None
+        return response
+
+    def uploadProcedures(self, df, assignedSensorIds=None, procedures=None, chunkSize=None, incremental=True):
+        """
+        insertObservations for several procedures of the lake at the same time (workers
+        threads), e.g. all the procedures from a single lakesStats file:
+            df = pd.read_csv('lakesStats_CHL.csv', parse_dates=['date'])
+            report = c.uploadProcedures(df)
+        Returns a dataframe with a summary row for each procedure (and its error).
+        """
+        procedures = procedures or self.procedures
+        assignedSensorIds = assignedSensorIds or self.getProcedureIDs()
+
+        def upload(PROCEDURE):
+            if assignedSensorIds.get(PROCEDURE) is None:
+                return {'procedure': PROCEDURE, 'error': 'The procedure could not be retrieved'}
+            try:
+                return self.insertObservations(PROCEDURE, assignedSensorIds[PROCEDURE], df, chunkSize=chunkSize, incremental=incremental)
+            except Exception as e:
+                return {'procedure': PROCEDURE, 'error': f'{type(e).__name__}: {e}'}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            rows = list(executor.map(upload, procedures))
+        return pd.DataFrame(rows, columns=['procedure', 'statistic', 'last', 'dates', 'chunks', 'error'])
     
-def updateDataRequest(df, dataSample, WQP_DEFINITIONS, WQP_PROCEDURES, PROCEDURE, STATISTIC):
-    d = dataSample
-    wqps = list(set(PROCEDURE.split('_')).intersection(WQP_PROCEDURES))
-    print(wqps)
-    
-    DATE_START = pytz.utc.localize(df.date.min()).isoformat().replace('+00:00','Z')
-    DATE_END = pytz.utc.localize(df.date.max()).isoformat().replace('+00:00','Z')
-    print(DATE_START)
-    print(DATE_END)
-    d['samplingTime'] = {
-        'beginPosition':DATE_START,
-        'endPosition':DATE_END,
-    }
+def procedureWQPs(PROCEDURE, WQP_PROCEDURES):
+    # Water quality parameters of a procedure (in the order of WQP_PROCEDURES)
+    return [wqp for wqp in WQP_PROCEDURES if wqp in PROCEDURE.split('_')]
+
+def procedureBasin(PROCEDURE, STATISTIC):
+    # Basin of the statistics columns ({STATISTIC}_{BASIN}) of a procedure
+    if 'MA' in PROCEDURE.split('_'):
+        return 'MA'
+    if STATISTIC == 'mean':
+        return '_'.join(PROCEDURE.split('_')[-2:])
+    elif STATISTIC in ['percentile_25','percentile_75','std']:
+        return '_'.join(PROCEDURE.split('_')[-3:-1])
+
+def observationTemplate(dataSample, WQP_DEFINITIONS, WQP_PROCEDURES, PROCEDURE):
+    # Observation of a procedure without samplingTime and values (a copy of dataSample)
+    d = copy.deepcopy(dataSample)
+    wqps = procedureWQPs(PROCEDURE, WQP_PROCEDURES)
     d['procedure'] = f'urn:ogc:def:procedure:x-istsos:1.0:{PROCEDURE}'
     d['observedProperty']['CompositePhenomenon']['dimension'] = str(len(wqps)+1)
 
@@ -196,68 +372,189 @@ def updateDataRequest(df, dataSample, WQP_DEFINITIONS, WQP_PROCEDURES, PROCEDURE
     for wqp in wqps: 
         RES_DA_FIELDS.append(WQP_DEFINITIONS[wqp])
     d['result']['DataArray']['field'] = RES_DA_FIELDS
+    d['result']['DataArray']['values'] = []
+    return d, wqps
+
+def updateDataRequest(df, dataSample, WQP_DEFINITIONS, WQP_PROCEDURES, PROCEDURE, STATISTIC):
+    d, wqps = observationTemplate(dataSample, WQP_DEFINITIONS, WQP_PROCEDURES, PROCEDURE)
+    print(wqps)
     
-    if STATISTIC == 'mean':
-        if 'MA' in PROCEDURE.split('_'):
-            BASIN = 'MA'
-        else:
-            BASIN = '_'.join(PROCEDURE.split('_')[-2:])
-    elif STATISTIC in ['percentile_25','percentile_75','std']:
-        if 'MA' in PROCEDURE.split('_'):
-            BASIN = 'MA'
-        else:
-            BASIN = '_'.join(PROCEDURE.split('_')[-3:-1])
-    
-    d['result']['DataArray']['values'] = resultsWQPvalues(df, wqps, BASIN, STATISTIC)
+    DATE_START = pytz.utc.localize(df.date.min()).isoformat().replace('+00:00','Z')
+    DATE_END = pytz.utc.localize(df.date.max()).isoformat().replace('+00:00','Z')
+    print(DATE_START)
+    print(DATE_END)
+    d['samplingTime'] = {
+        'beginPosition':DATE_START,
+        'endPosition':DATE_END,
+    }
+    d['result']['DataArray']['values'] = resultsWQPvalues(df, wqps, procedureBasin(PROCEDURE, STATISTIC), STATISTIC)
 
     return d
-        
+
+"""
+BULK UPLOAD OF THE OBSERVATIONS
+"""
+# Statistic of the procedures by name suffix (no suffix: mean)
+PROCEDURE_STATISTICS = {'1Q': 'percentile_25', '3Q': 'percentile_75', 'SD': 'std'}
+# Observations (dates) sent in each insertobservation request
+CHUNK_SIZE = 500
+
+def procedureStatistic(PROCEDURE):
+    return PROCEDURE_STATISTICS.get(PROCEDURE.split('_')[-1], 'mean')
+
+def lastEventTime(dataSample):
+    """
+    Time (UTC, without timezone) of the last observation of a procedure in the
+    response of getRequestSample (eventtime/last), None if the procedure has no
+    observations.
+    """
+    values = dataSample.get('result', {}).get('DataArray', {}).get('values') or []
+    if values:
+        last = values[-1][0]
+    else:
+        last = (dataSample.get('samplingTime') or {}).get('endPosition')
+    if not last:
+        return None
+    last = pd.Timestamp(last)
+    return last.tz_convert('UTC').tz_localize(None) if last.tzinfo is not None else last
+
+def dateChunks(df, chunkSize=CHUNK_SIZE):
+    # Statistics of chunkSize dates at a time (by date)
+    dates = df['date'].drop_duplicates().sort_values()
+    for i in range(0, len(dates), chunkSize):
+        yield df.loc[df['date'].isin(dates.iloc[i:i+chunkSize])]
+
+def valuesAfter(values, last):
+    # DataArray values after the time of the last observation (all of them without observations)
+    if last is None:
+        return values
+    times = pd.to_datetime([v[0] for v in values], utc=True).tz_localize(None)
+    return [v for v, t in zip(values, times) if t > last]
+
+def streamObservation(observation, values, AssignedSensorId):
+    """
+    JSON body of an insertobservation request encoded piece by piece: the rows
+    of values are encoded one at a time instead of the whole dictionary.
+    """
+    SENTINEL = '"__values__"'
+    observation = dict(observation, result=dict(observation['result'], DataArray=dict(observation['result']['DataArray'], values='__values__')))
+    body = json.dumps({'AssignedSensorId': AssignedSensorId, 'ForceInsert': 'true', 'Observation': observation})
+    head, tail = body.split(SENTINEL)
+    yield (head + '[').encode('utf-8')
+    for i, row in enumerate(values):
+        yield ((',' if i else '') + json.dumps(row)).encode('utf-8')
+    yield (']' + tail).encode('utf-8')
 
 def appendStatsFile(df, out_path):
     """
         Export the statistics result to a file (append data if existing)
         df:  Pandas DataFrame exported into the .csv file
-        out_path: path to the csv storing the data
+        out_path: path to the csv storing the data, or to the folder of a
+                  wqpStatsStore (any path without the .csv extension)
     """
     out_file = out_path
     print(out_file)
+    if not out_file.lower().endswith('.csv'):
+        from wqpStatsStore import statsStore
+        return statsStore(out_file).write(df)
     if os.path.exists(out_file):
         df.to_csv(out_file,mode='a', header=False)
     else:
         df.to_csv(out_file) 
 
 def getGMLfeature(vector_path, procedure):
-    #Retrieve GML feature from GML file polygon type
-    with open(os.path.join(vector_path,f'{procedure}.gml')) as f:
-        lines = f.read()
-    geometry_procedure = lines.split('<ogr:geometryProperty>')[1].split("</ogr:geometryProperty>")[0]
+    #Retrieve GML feature from GML file polygon type (parsed once by the registry of the folder)
+    from wqpGML import getRegistry
+    geometry_procedure = getRegistry(vector_path).fragment(procedure)
+    if geometry_procedure is None:
+        raise ValueError(f'No geometry in {procedure}.gml')
     return geometry_procedure
 
-def resultsWQPvalues(df, WQP_INPUT, BASIN, STATISTIC):
-    RES_DA_VALUES = []
-    wqps = []
-    for k in WQP_INPUT:
-        if k == 'CHL':
-            wqps.append('CHL')
-        elif k == 'TURB':
-            wqps.append('TSM')
-        elif k == 'TEMP':
-            wqps.append('LSWT')     
+# Typology of the wqp products of each istSOS water quality parameter
+WQP_TYPOLOGIES = {'CHL': 'CHL', 'TURB': 'TSM', 'TEMP': 'LSWT'}
+
+def isoTimes(dates):
+    # UTC timestamps as in istSOS (e.g. 2019-03-15T09:42:18Z) formatted in bulk
+    dates = pd.DatetimeIndex(dates)
+    times = dates.strftime('%Y-%m-%dT%H:%M:%S')
+    fraction = dates.microsecond != 0
+    if fraction.any():
+        times = np.where(fraction, dates.strftime('%Y-%m-%dT%H:%M:%S.%f'), times)
+    return [t + 'Z' for t in times]
+
+def wqpValuesTable(df, WQP_INPUT=None, columns=None):
+    """
+    Statistics of a lakesStats dataframe pivoted in a single pass: one row per date
+    (in order of appearance) and a column for each (statistic column, typology),
+    with the first value of each date and typology. The statistics of every
+    basin and statistic (e.g. mean_CO_E, std_MA) of all the procedures of a lake
+    can be read from the same table.
+        WQP_INPUT: istSOS parameters (CHL, TURB, TEMP), default all
+        columns: statistic columns, default all the numeric columns
+    Returns the values table and the position in df of the first row of each
+    (date, typology), NaN when there are no statistics.
+    """
+    wqps = [WQP_TYPOLOGIES[k] for k in (WQP_INPUT or WQP_TYPOLOGIES) if k in WQP_TYPOLOGIES]
     df = df.loc[df['typology'].isin(wqps)]
-    dates_list = df['date'].unique()
-    for d in dates_list:
-        temp = [pytz.utc.localize(pd.to_datetime(d)).isoformat().replace('+00:00','Z')]
-        for wqp in wqps: 
-            try:
-                o = df.loc[(df['date']==d)&(df['typology']==wqp)].iloc[0][f'{STATISTIC}_{BASIN}']
-                temp.append(o)
-            except:
-                print('Missing value:', d,':',wqp,':',BASIN)
-        
-        RES_DA_VALUES.append(temp)
-                
-    return RES_DA_VALUES
+    if columns is None:
+        columns = [c for c in df.select_dtypes(include='number').columns if c not in ('date', 'typology')]
+    dates = pd.to_datetime(df['date'].unique())
+    first = df.assign(position=np.arange(len(df))).drop_duplicates(['date', 'typology'], keep='first').set_index(['date', 'typology'])
+    table = first[list(columns)].unstack('typology').reindex(dates)
+    table = table.reindex(columns=pd.MultiIndex.from_product([list(columns), wqps]))
+    positions = first['position'].unstack('typology').reindex(index=dates, columns=wqps)
+    return table, positions
 
-#
-    
-    
\ No newline at end of file
+def resultsWQPvalues(df, WQP_INPUT, BASIN, STATISTIC, table=None, returnMissing=False):
+    """
+    DataArray values ([time, value of each parameter]) of the {STATISTIC}_{BASIN}
+    column for the parameters WQP_INPUT. A (date, typology) without statistics is
+    left out of its row and listed in the missing dataframe (returnMissing).
+        table: wqpValuesTable of df, computed once for several procedures
+    """
+    wqps = [WQP_TYPOLOGIES[k] for k in WQP_INPUT if k in WQP_TYPOLOGIES]
+    column = f'{STATISTIC}_{BASIN}'
+    if table is None:
+        if column not in df.columns:
+            raise KeyError(f'Missing statistics column: {column}')
+        table = wqpValuesTable(df, [k for k in WQP_INPUT if k in WQP_TYPOLOGIES], [column])
+    values, positions = table
+    values = values[column].reindex(columns=wqps)
+    positions = positions.reindex(columns=wqps)
+    # Dates with values of at least one of the parameters, in order of appearance in df
+    order = positions.min(axis=1)
+    rows = np.flatnonzero(order.notna().values)
+    rows = rows[np.argsort(order.values[rows], kind='mergesort')]
+    values = values.iloc[rows]
+    present = positions.iloc[rows].notna()
+    times = isoTimes(values.index)
+    if present.values.all():
+        RES_DA_VALUES = [[t] + v for t, v in zip(times, values.values.tolist())]
+    else:
+        RES_DA_VALUES = [[t] + [x for x, p in zip(v, pv) if p] for t, v, pv in zip(times, values.values.tolist(), present.values.tolist())]
+    if not returnMissing:
+        return RES_DA_VALUES
+    missing = present.stack()
+    missing = missing.loc[~missing.values].reset_index()
+    missing.columns = ['date', 'typology', 'missing']
+    missing = missing.drop(columns='missing').assign(basin=BASIN, statistic=STATISTIC)
+    return RES_DA_VALUES, missing
+
+def procedureValues(df, procedures, WQP_PROCEDURES=istSOSClient.WQP_PROCEDURES):
+    """
+    DataArray values of several procedures (e.g. all the procedures of a lake or
+    of all the lakes) from a single pivot of a lakesStats dataframe.
+    Returns {procedure: values} and the missing values of all the procedures.
+    """
+    table = wqpValuesTable(df)
+    results = dict()
+    missing = []
+    for PROCEDURE in procedures:
+        STATISTIC = procedureStatistic(PROCEDURE)
+        BASIN = procedureBasin(PROCEDURE, STATISTIC)
+        if f'{STATISTIC}_{BASIN}' not in table[0].columns.get_level_values(0):
+            continue
+        results[PROCEDURE], m = resultsWQPvalues(df, procedureWQPs(PROCEDURE, WQP_PROCEDURES), BASIN, STATISTIC, table, returnMissing=True)
+        missing.append(m.assign(procedure=PROCEDURE))
+    missing = pd.concat(missing, ignore_index=True) if missing else pd.DataFrame(columns=['date', 'typology', 'basin', 'statistic', 'procedure'])
+    return results, missing
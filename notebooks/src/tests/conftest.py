@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of src/python are imported by name, as in the notebooks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
@@ -0,0 +1,223 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import pandas as pd
+import pytest
+from wqp_istSOS import istSOSClient, resultsWQPvalues
+
+SERVICE = 'demo'
+API_PREFIX = f'/istsos/wa/istsos/services/{SERVICE}'
+PROCEDURE = 'SATELLITE_CHL_TURB_CO_E'
+
+class stubServer(ThreadingMixIn, HTTPServer):
+    """
+    istSOS (and OpenID token endpoint) on localhost: issues numbered tokens,
+    rejects the revoked ones with 401, answers the scripted failures of a path
+    (failures[path] = [status, ...]) and records the inserted observations.
+    failuresAfter[path] are answered after the observation is inserted. As under
+    mod_wsgi, a chunked request body is rejected.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), stubHandler)
+        self.lock = threading.Lock()
+        self.expiresIn = 3600
+        self.tokens = []
+        self.valid = set()
+        self.failures = dict()
+        self.failuresAfter = dict()
+        self.hits = dict()
+        self.unauthorized = 0
+        self.lastTime = None
+        self.observations = []
+
+    @property
+    def host(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def revoke(self):
+        with self.lock:
+            self.valid.clear()
+
+def readBody(handler):
+    # Body with Content-Length (None for a chunked body)
+    if handler.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        handler.close_connection = True
+        return None
+    return handler.rfile.read(int(handler.headers.get('Content-Length', 0)))
+
+def observationSample(lastTime):
+    values = [[lastTime, 1.0, 2.0]] if lastTime is not None else []
+    return {
+        'procedure': f'urn:ogc:def:procedure:x-istsos:1.0:{PROCEDURE}',
+        'observedProperty': {'CompositePhenomenon': {'dimension': '3'}, 'component': []},
+        'samplingTime': {'beginPosition': lastTime, 'endPosition': lastTime},
+        'result': {'DataArray': {'elementCount': '3', 'field': [], 'values': values}},
+    }
+
+class stubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self, path):
+        # Token check and scripted failures of an API request
+        server = self.server
+        with server.lock:
+            server.hits[path] = server.hits.get(path, 0) + 1
+            token = self.headers.get('Authorization', '')[len('Bearer '):]
+            if token not in server.valid:
+                server.unauthorized += 1
+                status = 401
+            elif server.failures.get(path):
+                status = server.failures[path].pop(0)
+            else:
+                return True
+        self.reply(status, {'success': False, 'message': f'status {status}'})
+        return False
+
+    def do_GET(self):
+        path = self.path[len(API_PREFIX):]
+        if not self.authorized(path):
+            return
+        if path.startswith('/procedures/'):
+            self.reply(200, {'success': True, 'data': {'assignedSensorId': 'id-' + path.split('/')[-1]}})
+        elif '/operations/getobservation/' in path:
+            self.reply(200, {'success': True, 'message': 'ok', 'data': [observationSample(self.server.lastTime)]})
+        else:
+            self.reply(404, {'success': False, 'message': path})
+
+    def do_POST(self):
+        server = self.server
+        body = readBody(self)
+        if self.path.endswith('/openid-connect/token'):
+            with server.lock:
+                token = f'token-{len(server.tokens)}'
+                server.tokens.append(token)
+                server.valid.add(token)
+            self.reply(200, {'access_token': token, 'expires_in': server.expiresIn})
+            return
+        path = self.path[len(API_PREFIX):]
+        if not self.authorized(path):
+            return
+        if body is None:
+            self.reply(411, {'success': False, 'message': 'Chunked request body'})
+            return
+        with server.lock:
+            observation = json.loads(body.decode('utf-8'))
+            server.observations.append(observation)
+            server.lastTime = observation['Observation']['result']['DataArray']['values'][-1][0]
+            status = server.failuresAfter[path].pop(0) if server.failuresAfter.get(path) else 200
+        if status != 200:
+            self.reply(status, {'success': False, 'message': f'status {status}'})
+            return
+        self.reply(200, {'success': True, 'message': 'inserted'})
+
+@pytest.fixture
+def server():
+    server = stubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client(server, tmp_path):
+    env_file = tmp_path / 'env.json'
+    env_file.write_text(json.dumps({'grant_type': 'password', 'username': 'user', 'password': 'secret'}))
+    client = istSOSClient(server.host, dict(istSOSClient.HEADERS), SERVICE, 'COMO', str(env_file),
+                          workers=4, retries=3, backoff=0.01, timeout=10)
+    yield client
+    client.close()
+
+def test_token_shared_and_refreshed_before_expiry(server, client):
+    ids = client.getProcedureIDs()
+    assert ids == {p: f'id-{p}' for p in client.procedures}
+    # A single token for the concurrent requests
+    assert server.tokens == ['token-0']
+    # Token about to expire: refreshed before the request, never rejected by the server
+    client.tokenExpiry = time.monotonic() + client.TOKEN_REFRESH_MARGIN / 2
+    assert client.getProcedureID(PROCEDURE) == f'id-{PROCEDURE}'
+    assert server.tokens == ['token-0', 'token-1']
+    assert server.unauthorized == 0
+
+def test_rejected_token_is_refreshed_once(server, client):
+    client.getProcedureID(PROCEDURE)
+    server.revoke()
+    ids = client.getProcedureIDs()
+    assert len(ids) == len(client.procedures)
+    # The concurrent 401 responses refresh the token only once
+    assert server.tokens == ['token-0', 'token-1']
+    assert server.unauthorized >= 1
+
+def test_busy_server_is_retried(server, client):
+    path = f'/procedures/{PROCEDURE}'
+    server.failures[path] = [503, 502]
+    assert client.getProcedureID(PROCEDURE) == f'id-{PROCEDURE}'
+    assert server.hits[path] == 3
+    # Retries exhausted: the last response is returned
+    server.failures[path] = [503] * 10
+    assert client.getProcedureID(PROCEDURE) is None
+    assert server.hits[path] == 3 + client.retries + 1
+
+def test_failed_procedure_is_reported(server, client):
+    path = f'/procedures/{PROCEDURE}'
+    server.failures[path] = [404]
+    ids = client.getProcedureIDs()
+    # Every procedure is returned, None for the one that could not be retrieved
+    assert set(ids) == set(client.procedures)
+    assert ids[PROCEDURE] is None
+    report = client.uploadProcedures(lakesStats(pd.date_range('2019-03-01', periods=2, freq='D')),
+                                     assignedSensorIds=ids, procedures=[PROCEDURE])
+    assert report.loc[0, 'error'] == 'The procedure could not be retrieved'
+    assert '/operations/insertobservation' not in server.hits
+
+def lakesStats(dates):
+    rows = []
+    for i, date in enumerate(dates):
+        rows.append({'date': date, 'typology': 'CHL', 'mean_CO_E': 1.0 + i})
+        rows.append({'date': date, 'typology': 'TSM', 'mean_CO_E': 10.0 + i})
+    return pd.DataFrame(rows)
+
+def test_insert_observations_in_chunks(server, client):
+    dates = pd.date_range('2019-03-01 09:40:00', periods=7, freq='D')
+    df = lakesStats(dates)
+    # Dates after the last observation on the server are sent, 3 at a time
+    server.lastTime = dates[2].strftime('%Y-%m-%dT%H:%M:%SZ')
+    path = '/operations/insertobservation'
+    server.failures[path] = [500]
+    summary = client.insertObservations(PROCEDURE, f'id-{PROCEDURE}', df, chunkSize=3)
+    assert summary['dates'] == 4
+    assert summary['chunks'] == 2
+    # The failed chunk is sent again with the same body
+    assert server.hits[path] == 3
+    sent = [obs['Observation']['result']['DataArray']['values'] for obs in server.observations]
+    assert [len(values) for values in sent] == [3, 1]
+    expected = resultsWQPvalues(df.loc[df['date'] > dates[2]], ['CHL', 'TURB'], 'CO_E', 'mean')
+    assert sent[0] + sent[1] == expected
+    first = server.observations[0]
+    assert first['AssignedSensorId'] == f'id-{PROCEDURE}'
+    assert first['Observation']['samplingTime'] == {'beginPosition': expected[0][0], 'endPosition': expected[2][0]}
+
+def test_failed_insert_is_not_sent_twice(server, client):
+    dates = pd.date_range('2019-03-01 09:40:00', periods=5, freq='D')
+    df = lakesStats(dates)
+    path = '/operations/insertobservation'
+    # The first chunk is inserted but the response is an error
+    server.failuresAfter[path] = [502]
+    summary = client.insertObservations(PROCEDURE, f'id-{PROCEDURE}', df, chunkSize=3, incremental=False)
+    assert summary['dates'] == 5
+    assert server.hits[path] == 2
+    sent = [values for obs in server.observations for values in obs['Observation']['result']['DataArray']['values']]
+    assert sent == resultsWQPvalues(df, ['CHL', 'TURB'], 'CO_E', 'mean')
@@ -0,0 +1,57 @@
+import numpy as np
+import rasterio
+from affine import Affine
+from wqpFunctions import wqp, rasterLayer
+
+def referenceImage(tmp_path):
+    # Product covering the grid of the layers (named as the S3 wqp products)
+    path = str(tmp_path / 'S3A_CHL_EPSG32632_20190315T094218_L1.tif')
+    profile = {'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'height': 12, 'width': 12,
+               'crs': 'EPSG:32632', 'transform': Affine(10, 0, 500000, 0, -10, 5100000)}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(np.ones((1, 12, 12), dtype=np.float32))
+    src = wqp(path)
+    src.readWQP()
+    return src
+
+def overlappingLayers():
+    # Two overlapping layers: zeros and NaN of the first layer inside the overlap
+    first = np.arange(1, 65, dtype=np.float32).reshape(8, 8)
+    first[4:6, 4:6] = 0
+    first[6, 6] = np.nan
+    second = np.full((8, 8), 7, dtype=np.float32)
+    second[0, 0] = 0
+    return {
+        'Lugano': rasterLayer(first, Affine(10, 0, 500000, 0, -10, 5100000)),
+        'Como': rasterLayer(second, Affine(10, 0, 500040, 0, -10, 5099960)),
+    }
+
+def test_streamed_mosaic_equals_in_memory(tmp_path):
+    src = referenceImage(tmp_path)
+    layers = overlappingLayers()
+    memory_path = str(tmp_path / 'memory.tif')
+    stream_path = str(tmp_path / 'stream.tif')
+    src.mergeRasterCollectionsExport(layers, memory_path)
+    src.mergeRasterCollectionsExport(layers, stream_path, stream=True)
+    src.closeWQP()
+    with rasterio.open(memory_path) as memory, rasterio.open(stream_path) as stream:
+        assert memory.transform == stream.transform
+        a = memory.read(1)
+        b = stream.read(1)
+    np.testing.assert_array_equal(a, b)
+    # The zeros of the first layer are no data, not replaced by the second layer
+    assert np.isnan(a[4:6, 4:6]).all()
+    # NaN of the first layer is filled by the second one
+    assert a[6, 6] == 7
+
+def test_default_order_of_the_lakes(tmp_path):
+    src = referenceImage(tmp_path)
+    layers = overlappingLayers()
+    # Insertion order and keys out of MERGE_ORDER do not change the mosaic
+    shuffled = {'Other': rasterLayer(np.full((12, 12), 99, dtype=np.float32), Affine(10, 0, 500000, 0, -10, 5100000)),
+                'Como': layers['Como'], 'Lugano': layers['Lugano']}
+    src.mergeRasterCollectionsExport(layers, str(tmp_path / 'lakes.tif'))
+    src.mergeRasterCollectionsExport(shuffled, str(tmp_path / 'shuffled.tif'))
+    src.closeWQP()
+    with rasterio.open(str(tmp_path / 'lakes.tif')) as a, rasterio.open(str(tmp_path / 'shuffled.tif')) as b:
+        np.testing.assert_array_equal(a.read(1), b.read(1))